@@ -1,54 +1,330 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+import hashlib
+import json
 import os
-from os.path import getsize, join, splitext, isdir 
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from os.path import join, splitext, isdir, isfile, islink
 from shutil import move
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
 class DirFlatten:
     ignore_list = [ './__classified__', './__flattened__' ]
+    extensions = [ '.pdf', '.epub', '.mobi' ]
 
-    def __init__(self):
+    def __init__(self, jobs=8, dedup='link'):
+        '''
+        dedup tells what to do with exact duplicates of flattened files:
+        'link' hard links them in __flattened__ under their own name and
+        removes them, 'skip' leaves them in place.
+        '''
         self.directory = os.curdir
         self.dir_flattened = join(self.directory, '__flattened__')
+        self.jobs = jobs
+        self.dedup = dedup
 
         if not isdir(self.dir_flattened):
             os.makedirs(self.dir_flattened)
 
+        self.index = DedupIndex(self.dir_flattened)
+
     def flatten(self):
         changed_folders = set()
 
-        for root, dirs, files in os.walk(self.directory):
-            for file in files:
-                is_movable = splitext(file)[1].lower() \
-                                in ['.pdf', '.epub', '.mobi']
-                is_movable = is_movable \
-                                and not any(
-                                    [ root.startswith(ilist)
-                                        for ilist in DirFlatten.ignore_list ])
+        # moves are done here, one at a time, while threads scan
+        try:
+            for root, file, size in self.walk():
+                self.move_file(root, file, size, changed_folders)
+        finally:
+            self.index.save()
 
-                if not (is_movable and getsize(join(root, file)) > 1024):
-                    continue
+        for folder in changed_folders:
+            move(folder, self.dir_flattened)
 
-                changed_folders.add(root)
+    def move_file(self, root, file, size, changed_folders):
+        src_file = join(root, file)
+        name_without_ext, ext = splitext(file)
+        name_without_ext = name_without_ext.replace('.', ' ') \
+                                           .replace('_', ' ') \
+                                           .replace('-', ' ')
+        filename = name_without_ext + ext
 
-                name_without_ext, ext = splitext(file)
-                name_without_ext = name_without_ext.replace('.', ' ') \
-                                                   .replace('_', ' ') \
-                                                   .replace('-', ' ')
-                filename = name_without_ext + ext
-                dest_file = join(self.dir_flattened, filename)
+        duplicate, hashes = self.index.find_duplicate(src_file, size)
+        # the index may be stale, duplicates are checked before the
+        # source is removed
+        while duplicate is not None \
+                and not self.index.check_duplicate(duplicate, size, hashes[1]):
+            duplicate, hashes = self.index.find_duplicate(src_file, size)
+        if duplicate is not None and self.dedup == 'skip':
+            print("{}/{}".format(root, file))
+            print("== {} (skipped)".format(join(self.dir_flattened, duplicate)))
+            return
 
-                print("{}/{}".format(root, file))
-                print("=> {}".format(dest_file))
-                move(join(root, file), dest_file)
+        changed_folders.add(root)
+        print("{}/{}".format(root, file))
 
-        for folder in changed_folders:
-            move(folder, self.dir_flattened)
+        if duplicate == filename:
+            print("== {}".format(join(self.dir_flattened, duplicate)))
+            os.remove(src_file)
+            return
+
+        # other contents with the same name are kept
+        filename = self.index.get_unique_name(filename)
+        dest_file = join(self.dir_flattened, filename)
+
+        if duplicate is not None:
+            try:
+                os.link(join(self.dir_flattened, duplicate), dest_file)
+                os.remove(src_file)
+                print("=> {} (link to {})".format(dest_file, duplicate))
+                self.index.add(filename, os.stat(dest_file), *hashes)
+                return
+            except OSError:
+                # no hard links here, the copy is moved
+                pass
+
+        print("=> {}".format(dest_file))
+        move(src_file, dest_file)
+        self.index.add(filename, os.stat(dest_file), *hashes)
+
+    def walk(self):
+        '''
+        Yields the (root, file, size) of movable files, directories being
+        scanned by a pool of threads.
+        '''
+        pool = ThreadPool(self.jobs)
+        try:
+            pending = deque([ pool.apply_async(self.scan_dir,
+                                               (self.directory,)) ])
+            while pending:
+                root, files, subdirs = pending.popleft().get()
+                for subdir in subdirs:
+                    pending.append(pool.apply_async(self.scan_dir, (subdir,)))
+                for file, size in files:
+                    yield root, file, size
+        finally:
+            pool.close()
+            pool.join()
+
+    def scan_dir(self, root):
+        '''
+        Returns root, its movable (file, size) and its subdirectories to
+        scan, ignored ones being pruned.
+        Only movable candidates are stat'ed, directories are told apart
+        by the entry type.
+        '''
+        ignore_prefixes = tuple(DirFlatten.ignore_list)
+        files = []
+        subdirs = []
+        try:
+            entries = list_dir(root)
+        except OSError:
+            # as os.walk, unreadable directories are skipped
+            return root, files, subdirs
+
+        for entry in entries:
+            path = join(root, entry.name)
+            if entry.is_dir():
+                if not entry.is_symlink() \
+                        and not path.startswith(ignore_prefixes):
+                    subdirs.append(path)
+            elif splitext(entry.name)[1].lower() in DirFlatten.extensions:
+                size = entry.stat().st_size
+                if size > 1024:
+                    files.append((entry.name, size))
+        return root, files, subdirs
+
+
+class DedupIndex:
+    '''
+    Index of the files of a directory by content, saved in the directory:
+    each file name maps to its size and mtime, the hash of its first block
+    and the hash of its whole content. Hashes are only computed when sizes
+    collide, the full hash only when first block hashes are equal, and
+    are dropped when the size or mtime of the file changed.
+    Names are saved as their file system bytes read as latin-1, so that
+    any name is read back as os.listdir returns it.
+    '''
+    filename = '.dedup_index.json'
+    block_size = 64 * 1024
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = join(directory, DedupIndex.filename)
+        self.files = {}
+        self.sizes = {}
+        if isfile(self.path):
+            with open(self.path) as f:
+                for key, desc in json.load(f).items():
+                    try:
+                        self.files[self.decode_name(key)] = desc
+                    except UnicodeEncodeError:
+                        # unicode names of older indexes, indexed again
+                        pass
+
+        # files removed or added by hand
+        names = set(name for name in os.listdir(directory)
+                    if isfile(join(directory, name))
+                    and not name.startswith(DedupIndex.filename))
+        descs = self.files
+        self.files = {}
+        for name in names:
+            stat = os.stat(join(directory, name))
+            desc = descs.get(name)
+            if desc is not None and desc['size'] == stat.st_size \
+                    and desc.get('mtime') == stat.st_mtime:
+                self.add(name, stat, desc['head'], desc['full'])
+            else:
+                # new or changed file
+                self.add(name, stat)
+
+    def add(self, name, stat, head=None, full=None):
+        self.files[name] = { 'size': stat.st_size, 'mtime': stat.st_mtime,
+                             'head': head, 'full': full }
+        self.sizes.setdefault(stat.st_size, []).append(name)
+
+    def remove(self, name):
+        self.sizes[self.files[name]['size']].remove(name)
+        del self.files[name]
+
+    def check_duplicate(self, name, size, full):
+        '''
+        Returns True if the indexed file name still has the given size and
+        full hash on disk, its entry is updated otherwise.
+        '''
+        file_path = join(self.directory, name)
+        desc = self.files[name]
+        self.remove(name)
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return False
+        if stat.st_size != size:
+            self.add(name, stat)
+            return False
+        actual = self.hash_file(file_path)
+        if actual == full:
+            self.add(name, stat, desc['head'], actual)
+            return True
+        head = actual if size <= self.block_size else None
+        self.add(name, stat, head, actual)
+        return False
+
+    def find_duplicate(self, file_path, size):
+        '''
+        Returns the name of an indexed file with the content of file_path,
+        or None, and the (head, full) hashes of file_path computed meanwhile.
+        '''
+        head = full = None
+        for name in self.sizes.get(size, []):
+            if head is None:
+                head = self.hash_file(file_path, self.block_size)
+                if size <= self.block_size:
+                    full = head
+            if self.get_hash(name, 'head') != head:
+                continue
+            if full is None:
+                full = self.hash_file(file_path)
+            if self.get_hash(name, 'full') == full:
+                return name, (head, full)
+        return None, (head, full)
+
+    def get_hash(self, name, key):
+        desc = self.files[name]
+        if desc[key] is None:
+            file_path = join(self.directory, name)
+            if key == 'head':
+                desc['head'] = self.hash_file(file_path, self.block_size)
+                if desc['size'] <= self.block_size:
+                    desc['full'] = desc['head']
+            else:
+                desc['full'] = self.hash_file(file_path)
+        return desc[key]
+
+    def get_unique_name(self, filename):
+        '''
+        Returns filename, or "<name> (<n>)<ext>" if it is taken.
+        '''
+        name_without_ext, ext = splitext(filename)
+        unique_name = filename
+        n = 1
+        while unique_name in self.files \
+                or os.path.lexists(join(self.directory, unique_name)):
+            unique_name = "{} ({}){}".format(name_without_ext, n, ext)
+            n += 1
+        return unique_name
+
+    def hash_file(self, file_path, max_size=None):
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            remaining = max_size
+            while remaining is None or remaining > 0:
+                size = self.block_size if remaining is None \
+                    else min(self.block_size, remaining)
+                block = f.read(size)
+                if not block:
+                    break
+                sha1.update(block)
+                if remaining is not None:
+                    remaining -= len(block)
+        return sha1.hexdigest()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict((self.encode_name(name), desc)
+                           for name, desc in self.files.items()),
+                      f, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    @staticmethod
+    def encode_name(name):
+        if not isinstance(name, bytes):
+            name = os.fsencode(name)
+        return name.decode('latin-1')
+
+    @staticmethod
+    def decode_name(key):
+        name = key.encode('latin-1')
+        if not isinstance(name, str):
+            name = os.fsdecode(name)
+        return name
+
+
+class ListDirEntry:
+    '''
+    os.DirEntry subset, for Python versions without scandir.
+    '''
+    def __init__(self, root, name):
+        self.name = name
+        self.path = join(root, name)
+
+    def is_dir(self):
+        return isdir(self.path)
+
+    def is_symlink(self):
+        return islink(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def list_dir(path):
+    if scandir is not None:
+        return list(scandir(path))
+    return [ ListDirEntry(path, name) for name in os.listdir(path) ]
 
 
 if __name__ == "__main__":
     flattener = DirFlatten()
     flattener.flatten()
-
-
@@ -1,25 +1,51 @@
 #!/bin/env python
 # -*- coding: utf-8 -*-
 
+from collections import deque
+from cStringIO import StringIO
 from datetime import datetime
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from os import path
-from shutil import rmtree, copy2
+from shutil import rmtree, copy2, copymode
+import ast
 import csv
+import json
 import os
+import re
 import sys
 import tarfile
 import difflib
+import hashlib
 import subprocess
 import logging
+import multiprocessing
+import struct
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 DIR_BASE = path.expandvars("$HOME/__patch_from_tar__/")
 DIR_WORKING = path.join(DIR_BASE, datetime.now().strftime("%Y-%m-%d_%H%M%S"))
 DIR_WORKING_EXTRACTED = path.join(DIR_WORKING, "extracted")
+DIR_CACHE = path.join(DIR_BASE, "cache")
+CACHE_MAX_SIZE = 512 * 1024 * 1024
 DIRNAME_META = 'META-INF'
 DIRNAME_META_OLDFILES = '{0}/oldfiles'.format(DIRNAME_META)
 DIRNAME_META_PATCHS = '{0}/patches'.format(DIRNAME_META)
+DIRNAME_META_HASHES = '{0}/hashes'.format(DIRNAME_META)
 FILENAME_MANIFEST = 'MANIFEST.mf'
+FILENAME_JOURNAL = 'JOURNAL'
+PATCH_HEADER = '#PATCH-OPCODES 1'
+XZ_MAGIC = '\xfd7zXZ\x00'
 
 
 def setup_logging(dir_name, filename="REPORT.log"):
@@ -43,92 +69,87 @@ def setup_logging(dir_name, filename="REPORT.log"):
     logging.getLogger('').addHandler(console)
 
 
-def task_build_tar(source_dir, tar_archive):
+def task_build_tar(source_dir, tar_archive, jobs=1, stream=False,
+                   cache_dir=None, compressor=None, cache_max=CACHE_MAX_SIZE):
     '''
     Validates source_dir and builds tar_archive on success
     :param source_dir: input source dir, using gp3-patcher convention
     :param tar_archive: output compressed archive
+    :param jobs: number of processes validating and diffing manifest rows
+    :param stream: writes meta-data straight to the archive, see
+                   _stream_build_tar
+    :param cache_dir: reuses backups and patches of previous builds, see
+                      _get_row_metas
+    :param compressor: TarCompressor of tar_archive, gzip by default
+    :param cache_max: size in bytes above which least recently used cache
+                      entries are removed, see _evict_cache
     '''
+    if compressor is None:
+        compressor = TarCompressor()
 
     dir_meta = path.join(source_dir, DIRNAME_META)
     dir_meta_oldfiles = path.join(source_dir, DIRNAME_META_OLDFILES)
     dir_meta_patchs = path.join(source_dir, DIRNAME_META_PATCHS)
+    dir_meta_hashes = path.join(source_dir, DIRNAME_META_HASHES)
     # create META folder structure
     if path.isdir(dir_meta):
         rmtree(dir_meta)
-    os.makedirs(dir_meta_oldfiles)
-    os.makedirs(dir_meta_patchs)
+    if stream:
+        os.makedirs(dir_meta)
+    else:
+        os.makedirs(dir_meta_oldfiles)
+        os.makedirs(dir_meta_patchs)
+        os.makedirs(dir_meta_hashes)
 
     setup_logging(dir_name=dir_meta)
 
     logging.info("### task: BUILD TAR ###")
     # validate source_dir structure
-    if not _validate_patch_dir(source_dir):
+    if not _validate_patch_dir(source_dir, jobs=jobs):
         return 1
 
     logging.info("Valid patch dir detected, generating meta-data ...")
 
-    # copy old files to META-INF/oldfiles
+    if stream:
+        _stream_build_tar(source_dir, tar_archive, jobs, cache_dir,
+                          compressor)
+        rmtree(dir_meta)
+        if cache_dir is not None:
+            _evict_cache(cache_dir, cache_max)
+        return 0
+
+    # copy old files to META-INF/oldfiles, their hash to META-INF/hashes
     # and generate patch to META-INF/patches
     manifest_path = path.join(source_dir, FILENAME_MANIFEST)
-    manifest_reader = csv.reader(open(manifest_path, "rb"),
-                                 delimiter=';', quotechar="'")
-    i = 0
-    for row in manifest_reader:
-        i = i + 1
-
-        fmodified_path = path.join(source_dir, row[0])
-        foriginal_path = my_expandvars(row[1])
-        is_newfile = True if row[2] == "Y" else False
-
-        backup_key = row[0]
-        fdiff_path = path.join(dir_meta_patchs, backup_key + ".patch")
-
-        row_result = 0
-
-        # copy original file if not new file
-        if not is_newfile:
-            # backup original file
-            fbkup_path = path.join(dir_meta_oldfiles, backup_key)
-            if not path.isdir(path.dirname(fbkup_path)):
-                os.makedirs(path.dirname(fbkup_path))
-            copy2(foriginal_path, fbkup_path)
-            # diff files
-            lines_original = open(foriginal_path).readlines()
-            lines_modified = open(fmodified_path).readlines()
-            diff_lines = _diff_files(lines_original, lines_modified)
-
-            if not path.isdir(path.dirname(fdiff_path)):
-                os.makedirs(path.dirname(fdiff_path))
-            fdiff = open(fdiff_path, 'w')
-            fdiff.writelines(diff_lines)
-            fdiff.close()
-
-            if len(diff_lines) < 1:
-                logging.warning("{0}[{1}] ({2}) no changes detected"
-                                .format(FILENAME_MANIFEST, i, row[0]))
-                row_result = 1
-        if row_result == 0:
-            logging.debug("OK> {0}[{1}] : {2}".format(FILENAME_MANIFEST,
-                                                      i, row[0]))
+    tasks = [(source_dir, dir_meta_oldfiles, dir_meta_patchs, dir_meta_hashes,
+              i, row, my_expandvars(row[1]), cache_dir)
+             for i, row in enumerate(_read_manifest(manifest_path), 1)]
+    for row_result, messages in _run_rows(_build_row, tasks, jobs):
+        _log_messages(messages)
 
     # tar source_dir
     logging.info("Creating tar archive ...")
-    tar = tarfile.open(tar_archive, "w:gz")
+    tar = compressor.open(tar_archive)
     tar.add(source_dir, arcname="")
-    tar.close()
+    compressor.close(tar)
 
     if path.isdir(dir_meta):
         rmtree(dir_meta)
+    if cache_dir is not None:
+        _evict_cache(cache_dir, cache_max)
 
     return 0
 
 
-def task_dry_run(tar_archive):
+def task_dry_run(tar_archive, jobs=1, stream=False):
     _create_working_dir()
     logging.info("### task: DRY RUN ###")
 
-    if not _uncompress_and_validate(tar_archive):
+    if stream:
+        valid = _stream_and_validate(tar_archive)
+    else:
+        valid = _uncompress_and_validate(tar_archive, jobs)
+    if not valid:
         logging.error("Patch can not be applied on this system.")
         return 1
     else:
@@ -136,11 +157,15 @@ def task_dry_run(tar_archive):
         return 0
 
 
-def task_safe_run(tar_archive):
+def task_safe_run(tar_archive, jobs=1, stream=False):
     _create_working_dir()
     logging.info("### task: SAFE RUN ###")
 
-    if not _uncompress_and_validate(tar_archive):
+    if stream:
+        valid = _stream_and_validate(tar_archive, extract=True)
+    else:
+        valid = _uncompress_and_validate(tar_archive, jobs)
+    if not valid:
         logging.error("Patch can not be applied on this system.")
         return 1
 
@@ -148,40 +173,47 @@ def task_safe_run(tar_archive):
 
     # lecture du fichier manifest
     manifest_path = path.join(DIR_WORKING_EXTRACTED, FILENAME_MANIFEST)
-    manifest_reader = csv.reader(open(manifest_path, "rb"),
-                                 delimiter=';', quotechar="'")
-    i = 0
-    result = True
-    for row in manifest_reader:
-        i = i + 1
-        row_result = True
+    suffix = ".{0}.patch".format(path.basename(DIR_WORKING))
+    entries = [_get_journal_entry(i, row, my_expandvars(row[1]), suffix)
+               for i, row in enumerate(_read_manifest(manifest_path), 1)]
 
-        # compute paths
-        dir_meta_patchs = path.join(DIR_WORKING_EXTRACTED, DIRNAME_META_PATCHS)
-        backup_key = row[0]
-        fdiff_path = path.join(dir_meta_patchs, backup_key + ".patch")
-        foriginal_path = my_expandvars(row[1])
-        is_newfile = True if row[2] == "Y" else False
-
-        # apply patch
-        if not is_newfile:
-            lines_patch = open(fdiff_path).readlines()
-            _apply_diff(lines_patch, foriginal_path)
-        else:
-            fmodified_path = path.join(DIR_WORKING_EXTRACTED, row[0])
-            if not path.isdir(path.dirname(foriginal_path)):
-                os.makedirs(path.dirname(foriginal_path))
-            copy2(fmodified_path, foriginal_path)
+    # journal temporary files before creating them
+    journal = PatchJournal(path.join(DIR_WORKING, FILENAME_JOURNAL))
+    journal.write(entries)
 
-        if row_result:
-            logging.info("PATCHED > {0}[{1}] ({2})".format(FILENAME_MANIFEST,
-                                                           i, row[0]))
-        else:
+    # write patched files next to their target
+    tasks = [(DIR_WORKING_EXTRACTED, entry, row)
+             for entry, row in izip(entries, _read_manifest(manifest_path))]
+    result = True
+    for row_result, messages in _run_rows(_prepare_row, tasks, jobs):
+        _log_messages(messages)
+        if not row_result:
             result = False
 
-    if result:
-        logging.info("All patchs applied successfully.")
-    return result
+    if not result:
+        journal.abort()
+        logging.error("No patch applied.")
+        return 1
+
+    # replace targets
+    journal.prepared()
+    logging.info("Replacing target files, journal: {0}".format(journal.path))
+    journal.commit()
+
+    logging.info("All patchs applied successfully.")
+    return 0
+
+
+def task_resume(journal_path):
+    _create_working_dir()
+    logging.info("### task: RESUME ###")
+    return PatchJournal(journal_path).resume()
+
+
+def task_rollback(journal_path):
+    _create_working_dir()
+    logging.info("### task: ROLLBACK ###")
+    return PatchJournal(journal_path).rollback()
 
 
 def _create_working_dir():
@@ -196,12 +228,17 @@ def _create_working_dir():
     print "Created DIR_WORKING: '{0}' ...".format(DIR_WORKING)
 
 
-def _validate_patch_dir(source_dir, with_metas=False):
+def _validate_patch_dir(source_dir, with_metas=False, jobs=1,
+                        streamed=None):
     '''
     Checks if source_dir follows gp3-patcher convention and that <listing.txt>
     can be applied on system
     :param source_dir: input source dir, using gp3-patcher convention
     :param with_metas: indicates if meta-inf subdirs should be checked
+    :param jobs: number of processes validating manifest rows
+    :param streamed: (member names, target diffs by backup key) read from a
+                     streamed archive, only the manifest is in source_dir.
+                     Rows without a target diff are not valid
     '''
     logging.info("Validating patch list ...")
 
@@ -212,130 +249,1088 @@ def _validate_patch_dir(source_dir, with_metas=False):
                       .format(FILENAME_MANIFEST))
         return False
 
-    # validate <listing.txt>
-    manifest_reader = csv.reader(open(manifest_path, "rb"),
-                                 delimiter=';', quotechar="'")
-    i = 0
-    result = True
-    for row in manifest_reader:
-        i = i + 1
+    # validate <listing.txt>, rows after an incorrect line are not checked
+    tasks = []
+    fatal_line = None
+    for i, row in enumerate(_read_manifest(manifest_path), 1):
         if len(row) != 3:
-            logging.error("FATAL>  {0} : line {1}, incorrect line format"
-                          .format(FILENAME_MANIFEST, i))
-            return False
+            fatal_line = i
+            break
+        if streamed is None:
+            row_members = None
+            target_diff = None
+        else:
+            row_members = set(name for name in _row_members(row[0])
+                              if name in streamed[0])
+            target_diff = streamed[1].get(row[0])
+        tasks.append((source_dir, with_metas, i, row, my_expandvars(row[1]),
+                      row_members, target_diff))
+
+    result = True
+    for row_result, messages in _run_rows(_validate_row, tasks, jobs):
+        _log_messages(messages)
+        if not row_result:
+            result = False
+
+    if fatal_line is not None:
+        logging.error("FATAL>  {0} : line {1}, incorrect line format"
+                      .format(FILENAME_MANIFEST, fatal_line))
+        return False
+    return result
 
-        fmodified_path = path.join(source_dir, row[0])
-        foriginal_path = my_expandvars(row[1])
-        is_newfile = True if row[2] == "Y" else False
 
-        row_result = True
-        if not path.isfile(fmodified_path):
-            logging.error("{0}[{1}] ({2}) modified file not found"
-                          .format(FILENAME_MANIFEST, i, row[0]))
+def _validate_row(task):
+    '''
+    Validates a manifest row.
+    Returns the row result and its (level, message) log records.
+    '''
+    (source_dir, with_metas, i, row, foriginal_path,
+     row_members, target_diff) = task
+    messages = []
+
+    def has_file(name):
+        if row_members is None:
+            return path.isfile(path.join(source_dir, name))
+        return name in row_members
+
+    is_newfile = True if row[2] == "Y" else False
+    modified_name, patch_name, original_name = _row_members(row[0])
+
+    row_result = True
+    if not has_file(modified_name):
+        messages.append((logging.ERROR,
+                         "{0}[{1}] ({2}) modified file not found"
+                         .format(FILENAME_MANIFEST, i, row[0])))
+        row_result = False
+    if is_newfile and path.isfile(foriginal_path):
+        messages.append((logging.ERROR,
+                         "{0}[{1}] ({2}) target file shouldn't exist"
+                         .format(FILENAME_MANIFEST, i, row[0])))
+        row_result = False
+    elif not is_newfile and not path.isfile(foriginal_path):
+        messages.append((logging.ERROR,
+                         "{0}[{1}] ({2}) target file not found ({3})"
+                         .format(FILENAME_MANIFEST, i, row[0], foriginal_path)))
+        row_result = False
+
+    # validate meta-inf subdir
+    if with_metas:
+        dir_meta_hashes = path.join(source_dir, DIRNAME_META_HASHES)
+        backup_key = row[0]
+        fmeta_original_path = path.join(source_dir, original_name)
+        fhash_path = path.join(dir_meta_hashes, backup_key + ".sha1")
+
+        if not is_newfile and not has_file(patch_name):
+            messages.append((logging.ERROR,
+                             "{0}[{1}] ({2}) patch file not found"
+                             .format(FILENAME_MANIFEST, i, row[0])))
             row_result = False
-        if is_newfile and path.isfile(foriginal_path):
-            logging.error("{0}[{1}] ({2}) target file shouldn't exist"
-                          .format(FILENAME_MANIFEST, i, row[0]))
+
+        if not is_newfile and not has_file(original_name):
+            messages.append((logging.ERROR,
+                             ("{0}[{1}] ({2}) original file not found "
+                              "in meta-inf").format(FILENAME_MANIFEST, i, row[0])))
             row_result = False
-        elif not is_newfile and not path.isfile(foriginal_path):
-            logging.error("{0}[{1}] ({2}) target file not found ({3})"
-                          .format(FILENAME_MANIFEST, i, row[0], foriginal_path))
+
+        # checking access rights
+        if row_result:
+            if is_newfile:
+                if not os.access(path.dirname(foriginal_path), os.W_OK):
+                    messages.append((logging.ERROR,
+                                     ("{0}[{1}] ({2}) no write access to"
+                                      " target dir").format(FILENAME_MANIFEST,
+                                                            i, row[0])))
+                    row_result = False
+            else:
+                if not os.access(foriginal_path, os.W_OK):
+                    messages.append((logging.ERROR,
+                                     ("{0}[{1}] ({2}) no write access to"
+                                      " target file").format(FILENAME_MANIFEST,
+                                                             i, row[0])))
+                    row_result = False
+                # patched files replace their target, see _prepare_row
+                freal_path = path.realpath(foriginal_path)
+                if not os.access(path.dirname(freal_path), os.W_OK):
+                    messages.append((logging.ERROR,
+                                     ("{0}[{1}] ({2}) no write access to"
+                                      " target dir").format(FILENAME_MANIFEST,
+                                                            i, row[0])))
+                    row_result = False
+                elif not _can_keep_owner(freal_path):
+                    messages.append((logging.ERROR,
+                                     ("{0}[{1}] ({2}) owner of target file"
+                                      " can't be kept").format(FILENAME_MANIFEST,
+                                                               i, row[0])))
+                    row_result = False
+
+        # streamed targets are diffed while reading the archive
+        if row_result and not is_newfile and row_members is not None and \
+           target_diff is None:
+            messages.append((logging.ERROR,
+                             ("{0}[{1}] ({2}) target file content could not"
+                              " be checked").format(FILENAME_MANIFEST,
+                                                    i, row[0])))
             row_result = False
 
-        # validate meta-inf subdir
-        if with_metas:
-            dir_meta_oldfiles = path.join(source_dir, DIRNAME_META_OLDFILES)
-            dir_meta_patchs = path.join(source_dir, DIRNAME_META_PATCHS)
-            backup_key = row[0]
-            fdiff_path = path.join(dir_meta_patchs, backup_key + ".patch")
-            fmeta_original_path = path.join(dir_meta_oldfiles, backup_key)
-
-            if not is_newfile and not path.isfile(fdiff_path):
-                logging.error("{0}[{1}] ({2}) patch file not found"
-                              .format(FILENAME_MANIFEST, i, row[0]))
+        # patch validation, archives built without hashes are always diffed
+        if row_result and not is_newfile:
+            if target_diff is not None:
+                diff_lines = target_diff
+            elif _has_expected_hash(fhash_path, foriginal_path):
+                diff_lines = []
+            else:
+                diff_lines = _diff_target(
+                    open(fmeta_original_path).readlines(), foriginal_path)
+            if len(diff_lines) > 0:
+                messages.append((logging.ERROR,
+                                 ("{0}[{1}] ({2}) target file content is not"
+                                  " valid :\n{3}")
+                                 .format(FILENAME_MANIFEST,
+                                         i, row[0], " " * 18 +
+                                         (" " * 18).join(diff_lines).rstrip())))
                 row_result = False
 
-            if not is_newfile and not path.isfile(fmeta_original_path):
-                logging.error(("{0}[{1}] ({2}) original file not found "
-                               "in meta-inf").format(FILENAME_MANIFEST, i, row[0]))
-                row_result = False
+    if row_result:
+        messages.append((logging.DEBUG, "OK> {0}[{1}] ({2})"
+                         .format(FILENAME_MANIFEST, i, row[0])))
+    return row_result, messages
 
-            # checking access rights
-            if row_result:
-                if is_newfile:
-                    if not os.access(path.dirname(foriginal_path), os.W_OK):
-                        logging.error(("{0}[{1}] ({2}) no write access to"
-                                       " target dir").format(FILENAME_MANIFEST,
-                                                             i, row[0]))
-                        row_result = False
-                else:
-                    if not os.access(foriginal_path, os.W_OK):
-                        logging.error(("{0}[{1}] ({2}) no write access to"
-                                       " target file").format(FILENAME_MANIFEST,
-                                                              i, row[0]))
-                        row_result = False
-
-            # patch validation
-            if row_result and not is_newfile:
-                # diff files
-                lines_meta_original = open(fmeta_original_path).readlines()
-                lines_original = open(foriginal_path).readlines()
-                diff_lines = list(difflib.unified_diff(lines_meta_original,
-                                                       lines_original,
-                                                       fromfile="expected file",
-                                                       tofile="actual file",
-                                                       n=0))
-                if len(diff_lines) > 0:
-                    logging.error(("{0}[{1}] ({2}) target file content is not"
-                                   " valid :\n{3}")
-                                  .format(FILENAME_MANIFEST,
-                                          i, row[0], " " * 18 +
-                                          (" " * 18).join(diff_lines).rstrip()))
-                    row_result = False
 
-        if row_result:
-            logging.debug("OK> {0}[{1}] ({2})".format(FILENAME_MANIFEST,
-                                                      i, row[0]))
+def _build_row(task):
+    '''
+    Backs up the original file of a manifest row and generates its patch.
+    Returns the row result and its (level, message) log records.
+    '''
+    (source_dir, dir_meta_oldfiles, dir_meta_patchs, dir_meta_hashes,
+     i, row, foriginal_path, cache_dir) = task
+    messages = []
+
+    fmodified_path = path.join(source_dir, row[0])
+    is_newfile = True if row[2] == "Y" else False
+
+    backup_key = row[0]
+    fdiff_path = path.join(dir_meta_patchs, backup_key + ".patch")
+
+    row_result = 0
+
+    # copy original file if not new file
+    if not is_newfile:
+        # diff files
+        original_hash, diff_lines = _get_row_metas(foriginal_path,
+                                                   fmodified_path, cache_dir)
+        # backup original file
+        fbkup_path = path.join(dir_meta_oldfiles, backup_key)
+        _makedirs(path.dirname(fbkup_path))
+        if cache_dir is None:
+            copy2(foriginal_path, fbkup_path)
         else:
-            result = False
-    return result
+            _link_or_copy(_cache_original(foriginal_path, original_hash,
+                                          cache_dir), fbkup_path)
+        # hash original file, checked first by dry runs
+        fhash_path = path.join(dir_meta_hashes, backup_key + ".sha1")
+        _makedirs(path.dirname(fhash_path))
+        with open(fhash_path, "w") as fhash:
+            fhash.write(original_hash + "\n")
+
+        _makedirs(path.dirname(fdiff_path))
+        fdiff = open(fdiff_path, 'w')
+        fdiff.writelines(diff_lines)
+        fdiff.close()
+
+        if not _has_changes(diff_lines):
+            messages.append((logging.WARNING, "{0}[{1}] ({2}) no changes detected"
+                             .format(FILENAME_MANIFEST, i, row[0])))
+            row_result = 1
+    if row_result == 0:
+        messages.append((logging.DEBUG, "OK> {0}[{1}] : {2}"
+                         .format(FILENAME_MANIFEST, i, row[0])))
+    return row_result, messages
+
+
+def _get_journal_entry(i, row, foriginal_path, suffix):
+    '''
+    Returns the journal entry of a manifest row. Its target is the real
+    path of foriginal_path, so that symlinked files are patched through
+    the link.
+    '''
+    target = path.realpath(foriginal_path)
+    is_newfile = True if row[2] == "Y" else False
+    return {"line": i, "name": row[0], "target": target,
+            "tmp": target + suffix + "-tmp",
+            "backup": None if is_newfile else target + suffix + "-bak"}
+
+
+def _prepare_row(task):
+    '''
+    Writes the patched file of a manifest row to the temporary file of its
+    journal entry, synced to disk.
+    Returns the row result and its (level, message) log records.
+    '''
+    dir_extracted, entry, row = task
+    messages = []
+
+    modified_name, patch_name, original_name = _row_members(row[0])
+
+    try:
+        if entry["backup"] is not None:
+            lines_patch = open(path.join(dir_extracted, patch_name)).readlines()
+            _apply_diff(lines_patch, entry["target"], entry["tmp"])
+        else:
+            _makedirs(path.dirname(entry["target"]))
+            copy2(path.join(dir_extracted, modified_name), entry["tmp"])
+            _fsync_file(entry["tmp"])
+    except (IOError, OSError, ValueError), e:
+        if path.isfile(entry["tmp"]):
+            os.remove(entry["tmp"])
+        messages.append((logging.ERROR, "{0}[{1}] ({2}) patch failed: {3}"
+                         .format(FILENAME_MANIFEST, entry["line"], row[0], e)))
+        return False, messages
+    return True, messages
+
+
+def _can_keep_owner(file_path):
+    '''
+    Returns True if a file created next to file_path can be given its
+    owner and group, as _apply_diff does.
+    '''
+    if os.geteuid() == 0:
+        return True
+    stat = os.stat(file_path)
+    if stat.st_uid != os.geteuid():
+        return False
+    dir_stat = os.stat(path.dirname(file_path))
+    if dir_stat.st_mode & 02000:
+        # set-group-ID dir, new files get its group
+        group = dir_stat.st_gid
+    else:
+        group = os.getegid()
+    return stat.st_gid == group or stat.st_gid in os.getgroups()
+
+
+def _fsync_file(file_path):
+    with open(file_path, "rb+") as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(dir_name):
+    '''
+    Syncs dir_name entries to disk, where the platform allows it.
+    '''
+    try:
+        fd = os.open(dir_name, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _diff_row(task):
+    '''
+    Hashes the original file of a manifest row and generates its patch,
+    in memory.
+    Returns the row result, its (level, message) log records and
+    its (hash, patch lines) meta-data, None for new files.
+    '''
+    source_dir, i, row, foriginal_path, cache_dir = task
+    messages = []
+
+    fmodified_path = path.join(source_dir, row[0])
+    is_newfile = True if row[2] == "Y" else False
+
+    row_result = 0
+    metas = None
 
+    if not is_newfile:
+        metas = _get_row_metas(foriginal_path, fmodified_path, cache_dir)
+        diff_lines = metas[1]
 
-def _uncompress_and_validate(tar_archive):
+        if not _has_changes(diff_lines):
+            messages.append((logging.WARNING, "{0}[{1}] ({2}) no changes detected"
+                             .format(FILENAME_MANIFEST, i, row[0])))
+            row_result = 1
+    if row_result == 0:
+        messages.append((logging.DEBUG, "OK> {0}[{1}] : {2}"
+                         .format(FILENAME_MANIFEST, i, row[0])))
+    return row_result, messages, metas
+
+
+def _get_row_metas(foriginal_path, fmodified_path, cache_dir=None):
+    '''
+    Returns the hash of the original file and its patch lines.
+    With cache_dir, patches are stored in <cache_dir>/patches by
+    (original, modified) content hashes and reused by later builds.
+    '''
+    original_hash = _hash_file(foriginal_path)
+    if cache_dir is not None:
+        fcache_path = path.join(cache_dir, "patches", "{0}-{1}.patch"
+                                .format(original_hash,
+                                        _hash_file(fmodified_path)))
+        if path.isfile(fcache_path):
+            _touch_cache(fcache_path)
+            return original_hash, open(fcache_path).readlines()
+
+    lines_original = open(foriginal_path).readlines()
+    lines_modified = open(fmodified_path).readlines()
+    diff_lines = _diff_files(lines_original, lines_modified)
+
+    if cache_dir is not None:
+        tmp_path = _get_cache_tmp_path(fcache_path)
+        with open(tmp_path, "w") as f:
+            f.writelines(diff_lines)
+        os.rename(tmp_path, fcache_path)
+    return original_hash, diff_lines
+
+
+def _cache_original(foriginal_path, original_hash, cache_dir):
+    '''
+    Returns the backup of the original file stored in <cache_dir>/originals
+    by content hash, copying it on first use.
+    '''
+    fcache_path = path.join(cache_dir, "originals", original_hash)
+    if path.isfile(fcache_path):
+        _touch_cache(fcache_path)
+    else:
+        tmp_path = _get_cache_tmp_path(fcache_path)
+        copy2(foriginal_path, tmp_path)
+        os.rename(tmp_path, fcache_path)
+    return fcache_path
+
+
+def _touch_cache(fcache_path):
+    '''
+    Marks a cache entry as used by its access time, its modification time
+    being the one of the backed up file.
+    '''
+    try:
+        os.utime(fcache_path, (time.time(), os.stat(fcache_path).st_mtime))
+    except OSError:
+        pass
+
+
+def _evict_cache(cache_dir, max_size):
+    '''
+    Removes the least recently used entries of cache_dir, by access time,
+    until it holds at most max_size bytes.
+    '''
+    entries = []
+    total = 0
+    for dir_name in ("originals", "patches"):
+        dir_path = path.join(cache_dir, dir_name)
+        if not path.isdir(dir_path):
+            continue
+        for name in os.listdir(dir_path):
+            # entries being written by another build
+            if name.endswith(".tmp"):
+                continue
+            entry_path = path.join(dir_path, name)
+            try:
+                st = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((st.st_atime, st.st_size, entry_path))
+            total = total + st.st_size
+
+    nb_removed = 0
+    for atime, size, entry_path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(entry_path)
+        except OSError:
+            continue
+        total = total - size
+        nb_removed = nb_removed + 1
+    if nb_removed:
+        logging.info("Removed {0} cache entries, {1} bytes left in {2}"
+                     .format(nb_removed, total, cache_dir))
+
+
+def _get_cache_tmp_path(fcache_path):
+    '''
+    Returns the temporary file renamed to fcache_path once written, other
+    processes may write the same cache entry meanwhile.
+    '''
+    _makedirs(path.dirname(fcache_path))
+    return "{0}.{1}.tmp".format(fcache_path, os.getpid())
+
+
+def _link_or_copy(source_path, dest_path):
+    '''
+    Hard links source_path to dest_path, copies it across file systems.
+    '''
+    try:
+        os.link(source_path, dest_path)
+    except OSError:
+        copy2(source_path, dest_path)
+
+
+def _row_members(backup_key):
+    '''
+    Returns the modified, patch and original file names of a manifest row,
+    relative to the archive root.
+    '''
+    return (backup_key,
+            path.join(DIRNAME_META_PATCHS, backup_key + ".patch"),
+            path.join(DIRNAME_META_OLDFILES, backup_key))
+
+
+def _diff_target(lines_meta_original, foriginal_path):
+    '''
+    Returns the unified diff from the expected lines to the target file.
+    '''
+    lines_original = open(foriginal_path).readlines()
+    return list(difflib.unified_diff(lines_meta_original,
+                                     lines_original,
+                                     fromfile="expected file",
+                                     tofile="actual file",
+                                     n=0))
+
+
+def _hash_file(file_path, block_size=1024 * 1024):
+    '''
+    Returns the sha1 hex digest of file_path, read by blocks.
+    '''
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        block = f.read(block_size)
+        while block:
+            sha1.update(block)
+            block = f.read(block_size)
+    return sha1.hexdigest()
+
+
+def _has_expected_hash(fhash_path, file_path):
+    '''
+    Returns True if file_path matches the hash stored in fhash_path.
+    '''
+    if not path.isfile(fhash_path):
+        return False
+    with open(fhash_path) as fhash:
+        expected = fhash.read().strip()
+    return _hash_file(file_path) == expected
+
+
+def _read_manifest(manifest_path):
+    with open(manifest_path, "rb") as f:
+        return list(csv.reader(f, delimiter=';', quotechar="'"))
+
+
+def _run_rows(row_fn, tasks, jobs=1):
+    '''
+    Yields the results of row_fn for each task, in tasks order.
+    With jobs > 1, tasks are run by a pool of processes.
+    '''
+    if jobs <= 1:
+        for task in tasks:
+            yield row_fn(task)
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(row_fn, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _log_messages(messages):
+    for level, message in messages:
+        logging.log(level, message)
+
+
+def _makedirs(dir_name):
+    '''
+    Creates dir_name if needed, other processes may create it meanwhile.
+    '''
+    if path.isdir(dir_name):
+        return
+    try:
+        os.makedirs(dir_name)
+    except OSError:
+        if not path.isdir(dir_name):
+            raise
+
+
+def _uncompress_and_validate(tar_archive, jobs=1):
     '''
     Uncompresses archive and validates it's content.
     :param tar_archive: tar archive to be processed
+    :param jobs: number of processes validating manifest rows
     '''
     logging.info("Uncompressing tar file ...")
 
-    if not tarfile.is_tarfile(tar_archive):
-        logging.error("FATAL> Not a tar archive file")
+    tar = _open_tar(tar_archive)
+    if tar is None:
         return False
 
     # uncompressing to DIR_WORKING_EXTRACTED folder
-    tar = tarfile.open(tar_archive, "r:*")
     tar.extractall(DIR_WORKING_EXTRACTED)
     tar.close()
 
     # validate patch
-    return _validate_patch_dir(DIR_WORKING_EXTRACTED, with_metas=True)
+    return _validate_patch_dir(DIR_WORKING_EXTRACTED, with_metas=True,
+                               jobs=jobs)
+
+
+def _open_tar(tar_archive, mode="r:*"):
+    '''
+    Opens tar_archive for reading, mode being "r:*" or "r|*".
+    Compression is detected by tarfile, or by XZ_MAGIC for xz archives.
+    Returns None if tar_archive can't be read.
+    '''
+    with open(tar_archive, "rb") as f:
+        is_xz = f.read(len(XZ_MAGIC)) == XZ_MAGIC
+
+    if is_xz:
+        if lzma is None:
+            logging.error("FATAL> xz archives need the lzma module")
+            return None
+        try:
+            return tarfile.open(fileobj=lzma.LZMAFile(tar_archive),
+                                mode=mode[:2])
+        except (tarfile.ReadError, lzma.LZMAError):
+            pass
+    elif tarfile.is_tarfile(tar_archive):
+        return tarfile.open(tar_archive, mode)
+
+    logging.error("FATAL> Not a tar archive file")
+    return None
+
+
+def _stream_build_tar(source_dir, tar_archive, jobs=1, cache_dir=None,
+                      compressor=None):
+    '''
+    Builds tar_archive from the manifest rows, without writing meta-data to
+    source_dir. The manifest comes first, then for each row its hash,
+    original file, patch and modified file, as _stream_and_validate
+    expects them.
+    '''
+    manifest_path = path.join(source_dir, FILENAME_MANIFEST)
+    tasks = [(source_dir, i, row, my_expandvars(row[1]), cache_dir)
+             for i, row in enumerate(_read_manifest(manifest_path), 1)]
+
+    if compressor is None:
+        compressor = TarCompressor()
+
+    logging.info("Creating tar archive ...")
+    tar = compressor.open(tar_archive)
+    try:
+        tar.add(manifest_path, arcname=FILENAME_MANIFEST)
+        for task, (row_result, messages, metas) in \
+                izip(tasks, _run_rows(_diff_row, tasks, jobs)):
+            _log_messages(messages)
+            row, foriginal_path = task[2], task[3]
+            modified_name, patch_name, original_name = _row_members(row[0])
+            if metas is not None:
+                digest, diff_lines = metas
+                _add_lines(tar, path.join(DIRNAME_META_HASHES,
+                                          row[0] + ".sha1"), [digest + "\n"])
+                _add_file(tar, foriginal_path, original_name)
+                _add_lines(tar, patch_name, diff_lines)
+            tar.add(path.join(source_dir, modified_name),
+                    arcname=modified_name)
+        tar.add(path.join(source_dir, DIRNAME_META, "REPORT.log"),
+                arcname=path.join(DIRNAME_META, "REPORT.log"))
+    finally:
+        compressor.close(tar)
+
+
+def _add_file(tar, file_path, name):
+    '''
+    Adds the content of file_path to tar as a file member, following
+    symlinks as copy2 does for non stream builds.
+    '''
+    with open(file_path, "rb") as f:
+        tarinfo = tar.gettarinfo(arcname=name, fileobj=f)
+        tar.addfile(tarinfo, f)
+
+
+def _add_lines(tar, name, lines):
+    '''
+    Adds lines to tar as a file member.
+    '''
+    data = "".join(lines)
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tarinfo.mtime = time.time()
+    tarinfo.mode = 0644
+    tar.addfile(tarinfo, StringIO(data))
+
+
+def _stream_and_validate(tar_archive, extract=False):
+    '''
+    Validates archive content while reading it once, the archive being built
+    with stream. Target files are only diffed against their original file
+    when their hash differs.
+    :param tar_archive: tar archive to be processed
+    :param extract: extracts the manifest, patches and new files needed
+                    to apply the archive
+    '''
+    logging.info("Streaming tar file ...")
+
+    tar = _open_tar(tar_archive, "r|*")
+    if tar is None:
+        return False
+
+    try:
+        member = tar.next()
+        if member is None or member.name != FILENAME_MANIFEST:
+            logging.error("FATAL> {0} is not the first archive member,"
+                          " archive was not built with --stream"
+                          .format(FILENAME_MANIFEST))
+            return False
+        tar.extract(member, DIR_WORKING_EXTRACTED)
+        manifest_path = path.join(DIR_WORKING_EXTRACTED, FILENAME_MANIFEST)
+
+        # backup key and target of original files, new files to extract
+        originals = {}
+        newfiles = set()
+        for row in _read_manifest(manifest_path):
+            if len(row) != 3:
+                break
+            if row[2] == "Y":
+                newfiles.add(row[0])
+            else:
+                originals[_row_members(row[0])[2]] = (row[0],
+                                                      my_expandvars(row[1]))
+
+        names = set()
+        hashes = {}
+        diffs = {}
+        for member in tar:
+            names.add(member.name)
+            if not member.isfile():
+                continue
+            if member.name.startswith(DIRNAME_META_HASHES + "/"):
+                backup_key = path.relpath(member.name[:-len(".sha1")],
+                                          DIRNAME_META_HASHES)
+                hashes[backup_key] = tar.extractfile(member).read().strip()
+            elif member.name in originals:
+                backup_key, foriginal_path = originals[member.name]
+                if not path.isfile(foriginal_path):
+                    continue
+                if _hash_file(foriginal_path) == hashes.get(backup_key):
+                    diffs[backup_key] = []
+                else:
+                    diffs[backup_key] = _diff_target(
+                        tar.extractfile(member).readlines(), foriginal_path)
+            elif extract and (member.name in newfiles or
+                              member.name.startswith(DIRNAME_META_PATCHS)):
+                tar.extract(member, DIR_WORKING_EXTRACTED)
+    finally:
+        tar.close()
+
+    # original files not read as regular files, only their hash is checked
+    for backup_key, foriginal_path in originals.values():
+        if backup_key in diffs or backup_key not in hashes:
+            continue
+        if path.isfile(foriginal_path) and \
+           _hash_file(foriginal_path) == hashes[backup_key]:
+            diffs[backup_key] = []
+
+    # validate patch
+    return _validate_patch_dir(DIR_WORKING_EXTRACTED, with_metas=True,
+                               streamed=(names, diffs))
+
+
+class TarCompressor(object):
+    '''
+    Opens tar archives for writing, compressed with one of COMPRESSIONS
+    at level, DEFAULT_LEVELS when None. With threads > 1, gz archives are
+    written by ParallelGzipFile.
+    '''
+    COMPRESSIONS = ["none", "gz", "bz2", "xz"]
+    # xz presets above 6 need hundreds of MB to compress
+    DEFAULT_LEVELS = {"none": None, "gz": 9, "bz2": 9, "xz": 6}
+
+    def __init__(self, compression="gz", level=None, threads=1):
+        if compression not in self.COMPRESSIONS:
+            raise ValueError("unknown compression: {0}".format(compression))
+        if compression == "xz" and lzma is None:
+            raise ValueError("xz compression needs the lzma module")
+        if level is None:
+            level = self.DEFAULT_LEVELS[compression]
+        self.compression = compression
+        self.level = level
+        self.threads = threads
+        self.fileobj = None
+
+    def open(self, tar_archive):
+        if self.compression == "none":
+            return tarfile.open(tar_archive, "w:")
+        if self.compression == "xz":
+            self.fileobj = lzma.LZMAFile(tar_archive, "w", preset=self.level)
+        elif self.compression == "gz" and self.threads > 1:
+            self.fileobj = ParallelGzipFile(tar_archive, self.level,
+                                            self.threads)
+        else:
+            return tarfile.open(tar_archive, "w:" + self.compression,
+                                compresslevel=self.level)
+        return tarfile.open(fileobj=self.fileobj, mode="w|")
+
+    def close(self, tar):
+        tar.close()
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+
+
+class ParallelGzipFile(object):
+    '''
+    Write-only gzip file, deflating BLOCK_SIZE blocks in threads.
+    Blocks are compressed independently and ended by a sync flush, so that
+    their concatenation is the deflate stream of a single gzip member.
+    '''
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, file_path, level=9, threads=2):
+        self.f = open(file_path, "wb")
+        self.level = level
+        self.pool = ThreadPool(threads)
+        self.max_pending = threads * 2
+        self.pending = deque()
+        self.buffers = []
+        self.buffered = 0
+        self.crc = 0
+        self.size = 0
+        # no file name, unknown os
+        self.f.write("\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) +
+                     "\x00\xff")
+
+    def write(self, data):
+        self.buffers.append(data)
+        self.buffered = self.buffered + len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.size = self.size + len(data)
+        if self.buffered >= self.BLOCK_SIZE:
+            self.flush_block()
+
+    def flush_block(self, last=False):
+        block = "".join(self.buffers)
+        self.buffers = []
+        self.buffered = 0
+        self.pending.append(self.pool.apply_async(deflate_block,
+                                                  ((block, self.level, last),)))
+        while self.pending and (last or len(self.pending) > self.max_pending):
+            self.f.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.f is None:
+            return
+        try:
+            self.flush_block(last=True)
+            self.f.write(struct.pack("<II", self.crc & 0xffffffff,
+                                     self.size & 0xffffffff))
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.f.close()
+            self.f = None
+
+
+def deflate_block(block_desc):
+    '''
+    Returns the raw deflate data of a ParallelGzipFile block.
+    '''
+    block, level, last = block_desc
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + \
+        compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class PatchJournal(object):
+    '''
+    Records the patched files of a safe run before they are written, so
+    that an interrupted run can be resumed or rolled back.
+    Each entry holds a target, its temporary patched file and the backup
+    hard link of the replaced file, None for new files. PREPARED is
+    appended once all temporary files are synced, DONE once the run is
+    completed or rolled back.
+    '''
+    PREPARED = "PREPARED"
+    DONE = "DONE"
+
+    def __init__(self, journal_path):
+        self.path = journal_path
+
+    def write(self, entries):
+        with open(self.path, "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, marker):
+        with open(self.path, "a") as f:
+            f.write(marker + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self):
+        '''
+        Returns the entries, True if their temporary files were all written
+        and True if the run completed.
+        '''
+        entries = []
+        prepared = False
+        done = False
+        with open(self.path) as f:
+            for line in f:
+                if line.strip() == self.PREPARED:
+                    prepared = True
+                elif line.strip() == self.DONE:
+                    done = True
+                else:
+                    entries.append(json.loads(line))
+        return entries, prepared, done
+
+    def prepared(self):
+        self.append(self.PREPARED)
+
+    def abort(self):
+        '''
+        Removes the temporary files of a run stopped before any target was
+        replaced.
+        '''
+        for entry in self.read()[0]:
+            if path.isfile(entry["tmp"]):
+                os.remove(entry["tmp"])
+        self.append(self.DONE)
+
+    def commit(self, entries=None):
+        '''
+        Replaces targets by their patched file, skipping those already
+        replaced, then removes backups.
+        '''
+        if entries is None:
+            entries = self.read()[0]
+        for entry in entries:
+            if path.isfile(entry["tmp"]):
+                if entry["backup"] and not path.isfile(entry["backup"]):
+                    _link_or_copy(entry["target"], entry["backup"])
+                os.rename(entry["tmp"], entry["target"])
+            logging.info("PATCHED > {0}[{1}] ({2})".format(FILENAME_MANIFEST,
+                                                           entry["line"],
+                                                           entry["name"]))
+        for dir_name in set(path.dirname(entry["target"]) for entry in entries):
+            _fsync_dir(dir_name)
+
+        self.append(self.DONE)
+        for entry in entries:
+            if entry["backup"] and path.isfile(entry["backup"]):
+                os.remove(entry["backup"])
+
+    def resume(self):
+        entries, prepared, done = self.read()
+        if not done:
+            if not prepared:
+                logging.error("FATAL> run interrupted while writing patched"
+                              " files, it can only be rolled back")
+                return 1
+            self.commit(entries)
+        logging.info("All patchs applied successfully.")
+        return 0
+
+    def rollback(self):
+        '''
+        Restores targets replaced by an interrupted run and removes its
+        temporary files.
+        '''
+        entries, prepared, done = self.read()
+        if done:
+            logging.error("FATAL> run completed, backups are removed")
+            return 1
+
+        for entry in entries:
+            if path.isfile(entry["tmp"]):
+                # not replaced, the backup is a link to the target
+                os.remove(entry["tmp"])
+                if entry["backup"] and path.isfile(entry["backup"]):
+                    os.remove(entry["backup"])
+            elif not prepared:
+                # not written yet, targets are untouched
+                continue
+            elif entry["backup"]:
+                os.rename(entry["backup"], entry["target"])
+            elif path.isfile(entry["target"]):
+                os.remove(entry["target"])
+            logging.info("RESTORED > {0}[{1}] ({2})".format(FILENAME_MANIFEST,
+                                                            entry["line"],
+                                                            entry["name"]))
+        for dir_name in set(path.dirname(entry["target"]) for entry in entries):
+            _fsync_dir(dir_name)
+
+        # nothing left to resume or roll back
+        self.append(self.DONE)
+        logging.info("All patchs rolled back.")
+        return 0
+
+
+class EnvExpander(object):
+    '''
+    Expands paths as `. $HOME/sc_init.exe && echo "<path>"` would, with the
+    environment sourced once: $VAR and ${VAR} are expanded in-process,
+    paths using other shell syntax are still echoed by the shell.
+    Results are memoized.
+    '''
+    RE_VAR = re.compile(r'\$(?:\{([A-Za-z_][A-Za-z0-9_]*)\}|([A-Za-z_][A-Za-z0-9_]*))')
+    RE_SHELL_ONLY = re.compile(r'[\\`"]|\$(?![A-Za-z_]|\{[A-Za-z_][A-Za-z0-9_]*\})|^-')
+    CMD_INIT = '. $HOME/sc_init.exe'
+    ENVIRON_MARKER = '#--- EnvExpander environ ---#'
+
+    def __init__(self):
+        self.environ = None
+        self.results = {}
+
+    def load_environ(self):
+        '''
+        Sources the init script once, all its variables being exported.
+        The environment is printed after ENVIRON_MARKER, following any
+        output of the init script. Returns {} if it can't be read.
+        '''
+        cmd = ('set -a && {0} && "{1}" -c "import os, sys;'
+               ' sys.stdout.write(\'\\n{2}\\n\' + repr(dict(os.environ)))"'
+               .format(self.CMD_INIT, sys.executable, self.ENVIRON_MARKER))
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
+        output = process.communicate()[0]
+        marker = "\n" + self.ENVIRON_MARKER + "\n"
+        if process.returncode != 0 or marker not in output:
+            return {}
+        try:
+            environ = ast.literal_eval(output.rpartition(marker)[2])
+        except (ValueError, SyntaxError):
+            return {}
+        if not isinstance(environ, dict):
+            return {}
+        return environ
+
+    def expand_in_shell(self, path):
+        return subprocess.Popen(self.CMD_INIT + ' && echo "' + path + '"',
+                                stdout=subprocess.PIPE,
+                                shell=True).communicate()[0].rstrip()
+
+    def expand(self, path):
+        if path in self.results:
+            return self.results[path]
+
+        if self.environ is None:
+            self.environ = self.load_environ()
+
+        if not self.environ or self.RE_SHELL_ONLY.search(path):
+            result = self.expand_in_shell(path)
+        else:
+            result = self.RE_VAR.sub(
+                lambda m: self.environ.get(m.group(1) or m.group(2), ''),
+                path).rstrip()
+            # echo may interpret these
+            if '\\' in result or result.startswith('-'):
+                result = self.expand_in_shell(path)
+
+        self.results[path] = result
+        return result
+
+
+_env_expander = EnvExpander()
 
 
 def my_expandvars(path):
-    return subprocess.Popen('. $HOME/sc_init.exe && echo "' + path + '"',
-                            stdout=subprocess.PIPE,
-                            shell=True).communicate()[0].rstrip()
+    return _env_expander.expand(path)
 
 
 def _diff_files(original_lines, modified_lines):
-    return list(difflib.ndiff(original_lines, modified_lines))
+    '''
+    Returns the patch lines from original_lines to modified_lines:
+        "#PATCH-OPCODES 1 <nb original lines>"
+        then for each change "@ <i1> <i2> <n>" followed by the n lines
+        replacing original_lines[i1:i2]
+    '''
+    # common head and tail are left out of the matcher
+    nb_original = len(original_lines)
+    nb_modified = len(modified_lines)
+    head = 0
+    while head < min(nb_original, nb_modified) and \
+            original_lines[head] == modified_lines[head]:
+        head = head + 1
+    tail = 0
+    while tail < min(nb_original, nb_modified) - head and \
+            original_lines[nb_original - tail - 1] == \
+            modified_lines[nb_modified - tail - 1]:
+        tail = tail + 1
+
+    matcher = difflib.SequenceMatcher(
+        None, original_lines[head:nb_original - tail],
+        modified_lines[head:nb_modified - tail])
+
+    patch_lines = ["{0} {1}\n".format(PATCH_HEADER, nb_original)]
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        patch_lines.append("@ {0} {1} {2}\n".format(head + i1, head + i2,
+                                                   j2 - j1))
+        patch_lines.extend(modified_lines[head + j1:head + j2])
+    return patch_lines
+
+
+def _has_changes(patch_lines):
+    '''
+    Returns False for a patch without any change.
+    '''
+    if patch_lines and patch_lines[0].startswith(PATCH_HEADER):
+        return len(patch_lines) > 1
+    # ndiff patches
+    return len(patch_lines) > 0
 
 
-def _apply_diff(patch_lines, dest_file):
-    patched = difflib.restore(patch_lines, 2)
+def _patch_lines(patch_lines, original_lines):
+    '''
+    Returns original_lines patched with a _diff_files patch.
+    '''
+    nb_original = int(patch_lines[0].split()[2])
+    if nb_original != len(original_lines):
+        raise ValueError("patch expects {0} lines, target has {1}"
+                         .format(nb_original, len(original_lines)))
+
+    patched = []
+    pos = 0
+    idx = 1
+    while idx < len(patch_lines):
+        marker, i1, i2, count = patch_lines[idx].split()
+        i1, i2, count = int(i1), int(i2), int(count)
+        patched.extend(original_lines[pos:i1])
+        patched.extend(patch_lines[idx + 1:idx + 1 + count])
+        pos = i2
+        idx = idx + 1 + count
+    patched.extend(original_lines[pos:])
+    return patched
+
+
+def _apply_diff(patch_lines, dest_file, output_file):
+    '''
+    Writes dest_file patched to output_file, with the owner and mode of
+    dest_file.
+    '''
+    if patch_lines and patch_lines[0].startswith(PATCH_HEADER):
+        with open(dest_file) as f:
+            patched = _patch_lines(patch_lines, f.readlines())
+    else:
+        # archives built with ndiff patches
+        patched = difflib.restore(patch_lines, 2)
 
-    with open(dest_file, "w") as f:
+    with open(output_file, "w") as f:
         f.writelines(patched)
+        f.flush()
+        os.fsync(f.fileno())
+    dest_stat = os.stat(dest_file)
+    output_stat = os.stat(output_file)
+    if (dest_stat.st_uid, dest_stat.st_gid) != \
+       (output_stat.st_uid, output_stat.st_gid):
+        os.chown(output_file, dest_stat.st_uid, dest_stat.st_gid)
+    copymode(dest_file, output_file)
 
 
 def main():
@@ -358,6 +1353,19 @@ def main():
                       dest="safe_run",
                       help="run the patcher, ignoring non applicable changes")
 
+    # Recovery of an interrupted safe run
+    parser.add_option("--resume",
+                      action="store_const", const=1, default=0,
+                      dest="resume",
+                      help=("finish an interrupted safe run, the argument"
+                            " being its JOURNAL file"))
+
+    parser.add_option("--rollback",
+                      action="store_const", const=1, default=0,
+                      dest="rollback",
+                      help=("restore the files of an interrupted safe run,"
+                            " the argument being its JOURNAL file"))
+
     # Build Tar
     parser.add_option("-b", "--build-tar",
                       action="store",
@@ -366,6 +1374,57 @@ def main():
                       help=("validates source_dir and builds"
                             " tar_archive on success"))
 
+    # Jobs
+    parser.add_option("-j", "--jobs",
+                      action="store", type="int", default=1,
+                      dest="jobs", metavar="N",
+                      help="validate and diff manifest rows in N processes")
+
+    # Incremental build
+    parser.add_option("-i", "--incremental",
+                      action="store_true", default=False,
+                      dest="incremental",
+                      help=("reuse backups and patches of previous builds"
+                            " for unchanged (original, modified) files"))
+
+    parser.add_option("--cache-dir",
+                      action="store", default=DIR_CACHE,
+                      dest="cache_dir", metavar="DIR",
+                      help="incremental build cache [default: %default]")
+
+    parser.add_option("--cache-max",
+                      action="store", type="int",
+                      default=CACHE_MAX_SIZE / (1024 * 1024),
+                      dest="cache_max", metavar="MB",
+                      help=("remove least recently used cache entries above"
+                            " MB megabytes [default: %default]"))
+
+    # Compression
+    parser.add_option("-z", "--compression",
+                      action="store", type="choice", default="gz",
+                      choices=TarCompressor.COMPRESSIONS,
+                      dest="compression",
+                      help=("built archive compression: {0} [default: %default]"
+                            .format(", ".join(TarCompressor.COMPRESSIONS))))
+
+    parser.add_option("-l", "--level",
+                      action="store", type="int",
+                      dest="level", metavar="N",
+                      help=("built archive compression level, 1 to 9"
+                            " [default: 9, 6 for xz]"))
+
+    parser.add_option("--threads",
+                      action="store", type="int", default=1,
+                      dest="threads", metavar="N",
+                      help="compress gz archives in N threads")
+
+    # Stream
+    parser.add_option("-s", "--stream",
+                      action="store_true", default=False,
+                      dest="stream",
+                      help=("build or read the archive in one pass, without"
+                            " extracting it or writing meta-data to disk"))
+
     (options, args) = parser.parse_args()
 
     if len(sys.argv) <= 1:
@@ -374,23 +1433,38 @@ def main():
 
     # Check args
     build_tar = 0 if options.build_tar is None else 1
-    if options.dry_run + options.safe_run + build_tar > 1:
+    nb_actions = (options.dry_run + options.safe_run + build_tar +
+                  options.resume + options.rollback)
+    if nb_actions > 1:
         parser.error("mutually exclusive options detected")
     elif len(args) != 1:
         parser.error("incorrect number of arguments")
-    elif options.dry_run + options.safe_run + build_tar == 0:
+    elif nb_actions == 0:
         parser.error("no action specified")
     elif build_tar and not options.build_tar:
         parser.error("source_dir unspecified")
+    elif options.level is not None and not 1 <= options.level <= 9:
+        parser.error("compression level must be between 1 and 9")
+    elif options.compression == "xz" and lzma is None:
+        parser.error("xz compression needs the lzma module")
 
     # Processing
     out = 1  # error if no action specified
     if options.dry_run:
-        out = task_dry_run(args[0])
+        out = task_dry_run(args[0], options.jobs, options.stream)
     elif options.safe_run:
-        out = task_safe_run(args[0])
+        out = task_safe_run(args[0], options.jobs, options.stream)
+    elif options.resume:
+        out = task_resume(args[0])
+    elif options.rollback:
+        out = task_rollback(args[0])
     elif options.build_tar:
-        out = task_build_tar(options.build_tar, args[0])
+        cache_dir = options.cache_dir if options.incremental else None
+        compressor = TarCompressor(options.compression, options.level,
+                                   options.threads)
+        out = task_build_tar(options.build_tar, args[0], options.jobs,
+                             options.stream, cache_dir, compressor,
+                             options.cache_max * 1024 * 1024)
 
     if out == 0:
         logging.info("Done.")
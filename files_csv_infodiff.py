@@ -10,7 +10,14 @@ from optparse import OptionParser
 import json
 import codecs
 import re
+import multiprocessing
+import random
+import os
+import hashlib
 
+from itertools import islice
+
+from files_csv_transformer import MappedReader
 
 
 # --- Utility classes ----------------------------------------------------------
@@ -25,6 +32,22 @@ class MyEncoder(json.JSONEncoder):
             d['idx_end'] = o.end
             d['size'] = o.size
             d['type'] = ColumnInfo.type_tostr(o.type_detected)
+            if o.stats is not None:
+                d['stats'] = o.stats
+            return d
+        elif isinstance(o, ColumnStats):
+            d = {}
+            d['types'] = dict((ColumnInfo.type_tostr(k), v)
+                              for k, v in o.type_votes.items())
+            d['min_size'] = o.min_size
+            d['max_size'] = o.max_size
+            d['max_nb_decs'] = o.max_nb_decs
+            d['nb_values'] = o.nb_values
+            d['null_ratio'] = round(o.null_ratio(), 4)
+            d['samples'] = o.samples
+            if o.is_mixed():
+                d['mixed_types'] = [ColumnInfo.type_tostr(k)
+                                    for k in o.get_value_types()]
             return d
         elif isinstance(o, ColumnDiff):
             d = {}
@@ -74,6 +97,16 @@ class ColumnInfo(object):
     T_NUM_V4, T_DATE_8, T_TEXT = 1, 2, 3
     T_NUM, T_DATE_DB2 = 11, 12
 
+    # Dates, or a number: digits and "." with at most one ",", surrounded by
+    # whitespaces holding at most one "-".
+    RE_TYPE = re.compile(r'''
+          (?P<date_8>[12][0-9]{3}[01][0-9][0123][0-9]\Z)
+        | (?P<date_db2>[12][0-9]{3}-[01][0-9]-[0123][0-9]\Z)
+        | [ \t\n\r\v\f]*(?P<minus>-)?[ \t\n\r\v\f]*
+          (?P<core>[0-9.]*(?:,[0-9.]*)?)
+          [ \t\n\r\v\f]*(?(minus)|(?P<trail_minus>-)?)[ \t\n\r\v\f]*\Z
+        ''', re.VERBOSE)
+
     def __init__(self, idx, sample, start, end):
         '''
         Constructor.
@@ -86,14 +119,28 @@ class ColumnInfo(object):
 
         # Computed values
         self.name = "C-%s" % self.idx
-        self.type_detected = ColumnInfo.get_type(sample)
+        self.type_detected, self.nb_decs = ColumnInfo.classify(sample)
         self.size = self.end - self.start + 1
+        self.stats = None
 
-        if self.type_detected == ColumnInfo.T_NUM or \
-           self.type_detected == ColumnInfo.T_NUM_V4:
-            self.nb_decs = ColumnInfo.get_nb_decs(sample)
+    def apply_stats(self, stats):
+        '''
+        Replaces the first row guesses by the column statistics.
+        '''
+
+        self.stats = stats
+        self.type_detected = stats.get_type()
+        if ColumnInfo.is_num_type(self.type_detected):
+            self.nb_decs = stats.max_nb_decs
         else:
             self.nb_decs = 0
+        if stats.samples:
+            self.sample = stats.samples[0]
+
+    @staticmethod
+    def is_num_type(type_detected):
+        return type_detected == ColumnInfo.T_NUM or \
+               type_detected == ColumnInfo.T_NUM_V4
 
     @staticmethod
     def get_nb_decs(sample):
@@ -113,25 +160,45 @@ class ColumnInfo(object):
         Returns the type of the sample.
         '''
 
+        return ColumnInfo.classify(sample)[0]
+
+    @staticmethod
+    def classify(sample):
+        '''
+        Returns the type of the sample and its nb_decs, with one match of
+        RE_TYPE. Same results as the is_* tests and get_nb_decs.
+        '''
+
         if len(sample) > 29:
-            return ColumnInfo.T_TEXT
-        if not sample.strip():
-            return ColumnInfo.T_UNKNOW
+            return ColumnInfo.T_TEXT, 0
+
+        match = ColumnInfo.RE_TYPE.match(sample)
+        if match is None:
+            return ColumnInfo.T_TEXT, 0
 
         # Date
-        if ColumnInfo.is_date_8(sample):
-            return ColumnInfo.T_DATE_8
-        if ColumnInfo.is_date_db2(sample):
-            return ColumnInfo.T_DATE_DB2
+        if match.group("date_8") is not None:
+            return ColumnInfo.T_DATE_8, 0
+        if match.group("date_db2") is not None:
+            return ColumnInfo.T_DATE_DB2, 0
+
+        core = match.group("core")
+        if not core:
+            if match.group("minus") or match.group("trail_minus"):
+                return ColumnInfo.T_TEXT, 0
+            return ColumnInfo.T_UNKNOW, 0
 
         # Number
-        if ColumnInfo.is_v4_num(sample):
-            return ColumnInfo.T_NUM_V4
-        if ColumnInfo.is_num(sample):
-            return ColumnInfo.T_NUM
+        if len(sample) == 27 and sample[16] in ".,":
+            type_detected = ColumnInfo.T_NUM_V4
+        elif core[0] != "." and core[0] != "," and \
+             ("." in core or "," in core):
+            type_detected = ColumnInfo.T_NUM
+        else:
+            return ColumnInfo.T_TEXT, 0
 
-        # Text
-        return ColumnInfo.T_TEXT
+        sep_idx = max(sample.rfind("."), sample.find(","))
+        return type_detected, len(sample) - 1 - sep_idx
 
     @staticmethod
     def is_v4_num(sample):
@@ -216,6 +283,386 @@ class ColumnInfo(object):
             return "T_DATE_DB2"
 
 
+class ColumnStats(object):
+    '''
+    Streaming statistics of a csv column, in constant memory.
+    '''
+
+    NB_SAMPLES = 5
+
+    def __init__(self, idx):
+        self.idx = idx
+
+        self.type_votes = {}
+        self.min_size = None
+        self.max_size = 0
+        self.max_nb_decs = 0
+        self.nb_values = 0
+        self.nb_nulls = 0
+        self.samples = []
+
+    def add(self, value):
+        '''
+        Accounts a value of the column.
+        '''
+
+        self.nb_values = self.nb_values + 1
+
+        size = len(value)
+        if self.min_size is None or size < self.min_size:
+            self.min_size = size
+        if size > self.max_size:
+            self.max_size = size
+
+        type_detected, nb_decs = ColumnInfo.classify(value)
+        self.type_votes[type_detected] = self.type_votes.get(type_detected, 0) + 1
+
+        if type_detected == ColumnInfo.T_UNKNOW:
+            self.nb_nulls = self.nb_nulls + 1
+            return
+
+        if nb_decs > self.max_nb_decs:
+            self.max_nb_decs = nb_decs
+
+        if len(self.samples) < self.NB_SAMPLES and value not in self.samples:
+            self.samples.append(value)
+
+    def merge(self, other):
+        '''
+        Adds the statistics of other, computed on the rows after ours.
+        '''
+
+        self.nb_values = self.nb_values + other.nb_values
+        self.nb_nulls = self.nb_nulls + other.nb_nulls
+
+        if other.min_size is not None and \
+           (self.min_size is None or other.min_size < self.min_size):
+            self.min_size = other.min_size
+        self.max_size = max(self.max_size, other.max_size)
+        self.max_nb_decs = max(self.max_nb_decs, other.max_nb_decs)
+
+        for type_detected, count in other.type_votes.items():
+            self.type_votes[type_detected] = self.type_votes.get(type_detected, 0) + count
+
+        for value in other.samples:
+            if len(self.samples) >= self.NB_SAMPLES:
+                break
+            if value not in self.samples:
+                self.samples.append(value)
+
+    def to_dict(self):
+        d = dict(self.__dict__)
+        d['type_votes'] = self.type_votes.items()
+        return d
+
+    @staticmethod
+    def from_dict(d):
+        stats = ColumnStats(d['idx'])
+        stats.__dict__.update(d)
+        stats.type_votes = dict((int(k), v) for k, v in d['type_votes'])
+        stats.samples = [value.encode("latin-1") for value in d['samples']]
+        return stats
+
+    def get_type(self):
+        '''
+        Returns T_TEXT if any value is a text, else the type of all non
+        blank values. Blank columns and mixed types are T_UNKNOW.
+        '''
+
+        if ColumnInfo.T_TEXT in self.type_votes:
+            return ColumnInfo.T_TEXT
+        types = self.get_value_types()
+        if len(types) != 1:
+            return ColumnInfo.T_UNKNOW
+        return types[0]
+
+    def get_value_types(self):
+        '''
+        Returns the types of the non blank values.
+        '''
+
+        return sorted(type_detected for type_detected in self.type_votes
+                      if type_detected != ColumnInfo.T_UNKNOW)
+
+    def is_mixed(self):
+        return ColumnInfo.T_TEXT not in self.type_votes and \
+               len(self.get_value_types()) > 1
+
+    def null_ratio(self):
+        if self.nb_values == 0:
+            return 0.0
+        return float(self.nb_nulls) / self.nb_values
+
+
+class ColumnProfiler(object):
+    '''
+    Computes ColumnStats over the rows of a csv file, in one pass.
+    The scan stops after max_rows rows or max_bytes bytes when given.
+    With jobs > 1, byte-range shards of the file are profiled in a
+    process pool and their statistics merged.
+
+    With a sampling mode, at most sample_size rows are profiled:
+        head: the first rows
+        stride: every stride-th row
+        reservoir: uniform sample of the scanned rows
+        seek: rows at random byte offsets, no full scan
+    Random samples are reproducible from seed.
+    '''
+
+    SAMPLINGS = ["head", "stride", "reservoir", "seek"]
+
+    def __init__(self, max_rows=None, max_bytes=None, jobs=1,
+                 sampling=None, sample_size=10000, stride=100, seed=0,
+                 cache=None):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.jobs = jobs
+        self.sampling = sampling
+        self.sample_size = sample_size
+        self.stride = max(1, stride)
+        self.seed = seed
+        self.cache = cache
+
+    def get_settings(self):
+        '''
+        Returns the settings changing the profile results.
+        '''
+
+        settings = [self.max_rows, self.max_bytes, self.sampling]
+        if self.sampling is not None:
+            settings.extend([self.sample_size, self.stride, self.seed])
+        return settings
+
+    def profile(self, csv_file, nb_cols):
+        '''
+        Returns the ColumnStats of the first nb_cols columns.
+        '''
+
+        if self.cache is not None:
+            results = self.cache.get(csv_file, self.get_settings(), nb_cols)
+            if results is not None:
+                return results
+
+        # Row budgets and samplings need the rows in order
+        if self.jobs > 1 and self.max_rows is None and self.sampling is None:
+            results = self.profile_shards(csv_file, nb_cols)
+        else:
+            results = [ColumnStats(i + 1) for i in xrange(nb_cols)]
+            with MappedReader(csv_file) as reader:
+                self.profile_records(self.sample_records(reader), results)
+
+        if self.cache is not None:
+            self.cache.put(csv_file, self.get_settings(), nb_cols, results)
+        return results
+
+    def sample_records(self, reader):
+        '''
+        Returns the records to profile, according to the sampling mode.
+        '''
+
+        if self.sampling is None:
+            return self.iter_records(reader)
+        elif self.sampling == "head":
+            return islice(self.iter_records(reader), self.sample_size)
+        elif self.sampling == "stride":
+            return islice(self.iter_records(reader), 0,
+                          self.sample_size * self.stride, self.stride)
+        elif self.sampling == "reservoir":
+            return self.reservoir_records(reader)
+        elif self.sampling == "seek":
+            return self.seek_records(reader)
+        raise Exception, "[E] Unknown sampling: %s" % self.sampling
+
+    def reservoir_records(self, reader):
+        rand = random.Random(self.seed)
+        reservoir = []
+        for i, row in enumerate(self.iter_records(reader)):
+            if i < self.sample_size:
+                reservoir.append(row)
+                continue
+            j = rand.randint(0, i)
+            if j < self.sample_size:
+                reservoir[j] = row
+        return reservoir
+
+    def seek_records(self, reader):
+        '''
+        Yields the records found at sample_size random offsets, each offset
+        being moved to the start of the next record.
+        '''
+
+        buf = reader.buffer
+        size = reader.size
+        if self.max_bytes is not None:
+            size = min(size, self.max_bytes)
+        if size == 0:
+            return
+
+        rand = random.Random(self.seed)
+        offsets = sorted(rand.randint(0, size - 1)
+                         for i in xrange(self.sample_size))
+
+        last_start = -1
+        for offset in offsets:
+            if offset > 0 and buf[offset - 1] != "\n":
+                offset = buf.find("\n", offset) + 1
+                if offset == 0 or offset >= size:
+                    continue
+            if offset == last_start:
+                continue
+            last_start = offset
+
+            end = buf.find("\n", offset)
+            if end == -1:
+                end = reader.size
+            yield buf[offset:end]
+
+    def profile_shards(self, csv_file, nb_cols):
+        ranges = MappedReader.split_ranges(csv_file, self.jobs * 4,
+                                           end=self.max_bytes)
+        shards = [(csv_file, start, end, nb_cols) for start, end in ranges]
+
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            shards_results = pool.map(profile_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+
+        results = [ColumnStats(i + 1) for i in xrange(nb_cols)]
+        for shard_results in shards_results:
+            for stats, shard_stats in zip(results, shard_results):
+                stats.merge(shard_stats)
+        return results
+
+    def iter_records(self, reader):
+        buf = reader.buffer
+        nb_rows = 0
+        for start, end, has_newline in reader.offsets():
+            if self.max_rows is not None and nb_rows >= self.max_rows:
+                return
+            if self.max_bytes is not None and start >= self.max_bytes:
+                return
+            nb_rows = nb_rows + 1
+            yield buf[start:end]
+
+    @staticmethod
+    def profile_records(records, results):
+        nb_cols = len(results)
+        for row in records:
+            if not row.strip():
+                continue
+            for stats, value in zip(results, row.split(";", nb_cols)[:nb_cols]):
+                stats.add(value)
+
+
+class ProfileCache(object):
+    '''
+    On-disk cache of ColumnStats lists, one json file per entry.
+
+    Entries are keyed by the file path, size, mtime and a hash of its first
+    and last blocks, and by the profiler settings. Entries are touched when
+    read, the least recently used ones are removed above max_size bytes.
+    '''
+
+    VERSION = 1
+    BLOCK_SIZE = 64 * 1024
+    DIR_DEFAULT = os.path.expandvars("$HOME/.cache/files_csv_infodiff")
+
+    def __init__(self, cache_dir=DIR_DEFAULT, max_size=64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @staticmethod
+    def fingerprint(csv_file):
+        '''
+        Returns the identity of the file content, without reading it all.
+        '''
+
+        st = os.stat(csv_file)
+        digest = hashlib.sha1()
+        with open(csv_file, "rb") as f:
+            digest.update(f.read(ProfileCache.BLOCK_SIZE))
+            if st.st_size > ProfileCache.BLOCK_SIZE:
+                f.seek(max(ProfileCache.BLOCK_SIZE, st.st_size - ProfileCache.BLOCK_SIZE))
+                digest.update(f.read(ProfileCache.BLOCK_SIZE))
+        return [os.path.abspath(csv_file), st.st_size, st.st_mtime,
+                digest.hexdigest()]
+
+    def get_entry_path(self, csv_file, settings, nb_cols):
+        key = json.dumps([self.VERSION, self.fingerprint(csv_file),
+                          settings, nb_cols])
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(key).hexdigest() + ".json")
+
+    def get(self, csv_file, settings, nb_cols):
+        '''
+        Returns the cached ColumnStats list, or None.
+        '''
+
+        entry_path = self.get_entry_path(csv_file, settings, nb_cols)
+        try:
+            with open(entry_path, "rb") as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+        os.utime(entry_path, None)
+        return [ColumnStats.from_dict(d) for d in data]
+
+    def put(self, csv_file, settings, nb_cols, results):
+        entry_path = self.get_entry_path(csv_file, settings, nb_cols)
+        tmp_path = "%s.%s.tmp" % (entry_path, os.getpid())
+        with open(tmp_path, "wb") as fp:
+            json.dump([stats.to_dict() for stats in results], fp,
+                      encoding="latin-1")
+        os.rename(tmp_path, entry_path)
+
+        self.evict()
+
+    def evict(self):
+        '''
+        Removes least recently used entries above max_size bytes.
+        '''
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            entry_path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry_path))
+            total = total + st.st_size
+
+        for mtime, size, entry_path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            total = total - size
+
+
+def profile_shard(shard):
+    '''
+    Returns the ColumnStats of a byte range of the file, in a pool worker.
+    '''
+
+    csv_file, start, end, nb_cols = shard
+    results = [ColumnStats(i + 1) for i in xrange(nb_cols)]
+    with MappedReader(csv_file, start, end) as reader:
+        ColumnProfiler.profile_records(reader.records(), results)
+    return results
+
+
 class ColumnDiff(object):
     '''
     Contains the diff description of a column.
@@ -251,16 +698,20 @@ class ColumnDiff(object):
 
 # --- Actions ------------------------------------------------------------------
 
-def get_cols_infos(csv_file):
+def get_cols_infos(csv_file, profiler=None):
     '''
     Describes cols informations.
+    Types and nb_decs are guessed from the first row, or from the
+    statistics of the profiler when given.
     '''
 
     # Get CSV row with trailing ";"
-    with open(csv_file, "rb") as f:
-        row = f.next()
+    with MappedReader(csv_file) as reader:
+        row = reader.first_record()
+    if row is None:
+        raise Exception, "[E] %s: empty file." % csv_file
     if not row.rstrip().endswith(";"):
-        row.append(";")
+        row = row + ";"
 
     results = []
 
@@ -280,6 +731,10 @@ def get_cols_infos(csv_file):
         start = next_start + 1
         idx = row.find(';', start)
 
+    if profiler is not None:
+        for col_infos, stats in zip(results, profiler.profile(csv_file, len(results))):
+            col_infos.apply_stats(stats)
+
     return results
 
 def display_unknows(col_infos):
@@ -305,13 +760,13 @@ def gen_reduce_changes(col_diffs):
     str_idxs = " ".join(results)
     print "$UTILS/sc_reduce_col.pexe $FIC_TRANS %s > $FIC_INFO" % str_format
 
-def get_cols_diffs(first_csv, second_csv):
+def get_cols_diffs(first_csv, second_csv, profiler=None):
     '''
     Diffs 2 CSV files.
     '''
     results = []
-    first_results = get_cols_infos(first_csv)
-    second_results = get_cols_infos(second_csv)
+    first_results = get_cols_infos(first_csv, profiler)
+    second_results = get_cols_infos(second_csv, profiler)
 
     # Create ColumnDiffs and keep guessing types
     i = 0
@@ -353,10 +808,23 @@ def main(options, args):
 
     results = []
 
+    profiler = None
+    if options.profile or options.sampling:
+        profiler = ColumnProfiler(max_rows=options.max_rows,
+                                  max_bytes=options.max_bytes,
+                                  jobs=options.jobs,
+                                  sampling=options.sampling,
+                                  sample_size=options.sample_size,
+                                  stride=options.stride,
+                                  seed=options.seed)
+        if options.cache or options.cache_dir:
+            profiler.cache = ProfileCache(options.cache_dir or ProfileCache.DIR_DEFAULT,
+                                          options.cache_size * 1024 * 1024)
+
     if options.describe_csv:
-        results = get_cols_infos(args[0])
+        results = get_cols_infos(args[0], profiler)
     elif options.diff_csv:
-        results = get_cols_diffs(args[0], args[1])
+        results = get_cols_diffs(args[0], args[1], profiler)
         gen_date_changes(results)
         # gen_reduce_changes(results)
 
@@ -382,6 +850,57 @@ if __name__ == '__main__':
                       dest="diff_csv",
                       help="Diff two CSV files")
 
+    # Profile whole file
+    parser.add_option("-p", "--profile",
+                      action="store_const", const=1, default=0,
+                      dest="profile",
+                      help="Guess types from all rows instead of the first one")
+    parser.add_option("--max-rows",
+                      action="store", type="int", default=None,
+                      dest="max_rows", metavar="N",
+                      help="Profile at most N rows")
+    parser.add_option("--max-bytes",
+                      action="store", type="int", default=None,
+                      dest="max_bytes", metavar="N",
+                      help="Profile at most N bytes")
+    parser.add_option("-j", "--jobs",
+                      action="store", type="int", default=1,
+                      dest="jobs", metavar="N",
+                      help="Profile file shards in N processes")
+
+    # Sampling
+    parser.add_option("-s", "--sampling",
+                      action="store", type="choice", default=None,
+                      choices=ColumnProfiler.SAMPLINGS,
+                      dest="sampling", metavar="MODE",
+                      help="Profile a sample of rows: %s" % ", ".join(ColumnProfiler.SAMPLINGS))
+    parser.add_option("--sample-size",
+                      action="store", type="int", default=10000,
+                      dest="sample_size", metavar="N",
+                      help="Number of sampled rows (default: %default)")
+    parser.add_option("--stride",
+                      action="store", type="int", default=100,
+                      dest="stride", metavar="K",
+                      help="Stride sampling step (default: %default)")
+    parser.add_option("--seed",
+                      action="store", type="int", default=0,
+                      dest="seed",
+                      help="Random sampling seed (default: %default)")
+
+    # Profile cache
+    parser.add_option("-c", "--cache",
+                      action="store_const", const=1, default=0,
+                      dest="cache",
+                      help="Reuse profiles of unchanged files")
+    parser.add_option("--cache-dir",
+                      action="store", default=None,
+                      dest="cache_dir", metavar="DIR",
+                      help="Profile cache dir (default: %s)" % ProfileCache.DIR_DEFAULT)
+    parser.add_option("--cache-size",
+                      action="store", type="int", default=64,
+                      dest="cache_size", metavar="MB",
+                      help="Profile cache max size (default: %default MB)")
+
     (options, args) = parser.parse_args()
 
     if len(sys.argv) <= 1:
@@ -402,6 +921,9 @@ if __name__ == '__main__':
         parser.error("display infos takes one arg")
     elif options.diff_csv and len(args) != 2:
         parser.error("diff_csv takes two args")
+    elif (options.cache or options.cache_dir) and \
+         not (options.profile or options.sampling):
+        parser.error("cache options need --profile or --sampling")
 
     # Processing
     main(options, args)
@@ -11,6 +11,17 @@ from optparse import OptionParser
 import json
 import codecs
 import re
+import time
+import os
+import mmap
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 # --- Transform Engine ---------------------------------------------------------
@@ -20,10 +31,16 @@ class Transformer(object):
     CSV Transform Engine.
     """
 
-    def __init__(self, path_format, path_input, path_output):
+    CHUNK_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, path_format, path_input, path_output, jobs=1,
+                 block_size=None, batch_size=0):
         self.path_format = path_format
         self.path_input = path_input
         self.path_output = path_output
+        self.jobs = jobs
+        self.block_size = block_size or BulkWriter.BLOCK_SIZE
+        self.batch_size = batch_size
 
         self.action_descs = {}
         self.current_line = 0
@@ -33,17 +50,56 @@ class Transformer(object):
         self.load_format()
         if self.real_max_cols == 0: return
 
-        runner = ActionRunner(self.action_descs)
+        with BulkWriter(self.path_output, self.block_size) as fout:
+            if self.jobs > 1:
+                self.run_chunks(fout)
+            else:
+                self.run_lines(fout)
+
+    def run_lines(self, fout):
+        runner = self.create_plan(self.action_descs, self.batch_size)
 
-        with open(self.path_input, "rb") as fin:
-            with open(self.path_output, "wt") as fout:
-                for line_in in fin:
-                    if len(line_in) < 3:
-                        continue
+        with MappedReader(self.path_input) as reader:
+            # Convert !
+            error_line = convert_records(runner, reader.records(min_length=3),
+                                         self.batch_size, fout.write_row)
+        if error_line is not None:
+            runner.replay(error_line, runner.count)
 
-                    # Convert !
-                    row_out = runner.run(line_in.rstrip("\n"))
-                    fout.write("%s\n" % ';'.join(row_out))
+    def run_chunks(self, fout):
+        """
+        Transforms newline-aligned chunks of the input in a process pool,
+        outputs are written in the original order.
+        """
+        chunks = iter(self.split_chunks(self.path_input, self.jobs, self.CHUNK_SIZE))
+        pool = multiprocessing.Pool(self.jobs, init_chunk_worker,
+                                    (self.action_descs, self.batch_size))
+
+        # At most 2 chunks per job are pending
+        pending = deque()
+        error_line = None
+        nb_rows_before = 0
+        try:
+            for chunk in islice(chunks, self.jobs * 2):
+                pending.append(pool.apply_async(transform_chunk, (chunk,)))
+
+            while pending:
+                output, nb_rows, error_line = pending.popleft().get()
+                fout.write(output)
+                if error_line is not None:
+                    break
+                nb_rows_before = nb_rows_before + nb_rows
+
+                for chunk in islice(chunks, 1):
+                    pending.append(pool.apply_async(transform_chunk, (chunk,)))
+        finally:
+            pool.close()
+            pool.join()
+
+        if error_line is not None:
+            # Replays the failing row to raise with the global line
+            runner = ActionPlan(self.action_descs)
+            runner.replay(error_line, nb_rows_before + nb_rows)
 
     def load_format(self):
         self.real_max_cols = self.estimate_column_count(self.path_input)
@@ -68,14 +124,248 @@ class Transformer(object):
                     self.action_descs[i] = ActionDesc(d)
 
 
+    @staticmethod
+    def create_plan(action_descs, batch_size):
+        if batch_size > 1:
+            return BatchPlan(action_descs)
+        return ActionPlan(action_descs)
+
+    @staticmethod
+    def split_chunks(file_path, jobs, chunk_size):
+        """
+        Returns (path, start, end) byte ranges ending on a newline.
+        """
+        return [(file_path, start, end) for start, end in
+                MappedReader.split_ranges(file_path, jobs * 4, chunk_size)]
+
     @staticmethod
     def estimate_column_count(file_path):
+        with MappedReader(file_path) as reader:
+            row = reader.first_record()
+        if row is None:
+            return 0
+        return len(row.rstrip().split(";"))
+
+
+# --- Readers ------------------------------------------------------------------
+
+class MappedReader(object):
+    """
+    mmap-backed reader of ";" separated records.
+
+    Records are located as offsets into the mapped buffer, a record is only
+    sliced when it is handed to the caller.
+    """
+
+    def __init__(self, path, start=0, end=None):
+        self.path = path
+        self.start = start
+        self.end = end
+
+        self.fp = open(path, "rb")
+        self.size = os.fstat(self.fp.fileno()).st_size
+        if self.size == 0:
+            self.buffer = ""
+        else:
+            self.buffer = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.end is None or self.end > self.size:
+            self.end = self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if not isinstance(self.buffer, basestring):
+            self.buffer.close()
+        self.fp.close()
+
+    def offsets(self):
+        """
+        Yields (start, end, has_newline) of each record, "\n" excluded.
+        """
+        find = self.buffer.find
+        start = self.start
+        end = self.end
+        while start < end:
+            idx = find("\n", start, end)
+            if idx == -1:
+                yield start, end, False
+                return
+            yield start, idx, True
+            start = idx + 1
+
+    def records(self, min_length=0):
+        """
+        Yields records, "\n" excluded.
+        Records shorter than min_length (counting the "\n") are skipped.
+        """
+        buf = self.buffer
+        for start, end, has_newline in self.offsets():
+            if end - start + has_newline < min_length:
+                continue
+            yield buf[start:end]
+
+    def first_record(self):
+        for record in self.records():
+            return record
+        return None
+
+    @staticmethod
+    def split_ranges(file_path, nb_ranges, max_size=None, end=None):
+        """
+        Returns about nb_ranges (start, end) byte ranges of at most
+        max_size bytes, each one ending on a newline.
+        When end is given, the ranges stop at the end of its record.
+        """
+        file_size = os.path.getsize(file_path)
+        if end is None or end > file_size:
+            end = file_size
+
+        range_size = end // nb_ranges + 1
+        if max_size:
+            range_size = min(range_size, max_size)
+
+        ranges = []
         with open(file_path, "rb") as f:
+            if 0 < end < file_size:
+                f.seek(end - 1)
+                f.readline()
+                end = f.tell()
+
+            start = 0
+            while start < end:
+                f.seek(min(start + range_size, end))
+                f.readline()
+                range_end = min(f.tell(), end)
+                ranges.append((start, range_end))
+                start = range_end
+        return ranges
+
+
+# --- Writers ------------------------------------------------------------------
+
+class BulkWriter(object):
+    """
+    Collects output rows and writes them in blocks of block_size bytes.
+    Writes to stdout when no path is given.
+    """
+
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, path=None, block_size=BLOCK_SIZE):
+        self.path = path
+        self.block_size = block_size
+
+        self.rows = []
+        self.size = 0
+        if path:
+            self.fp = open(path, "wb")
+        else:
+            self.fp = sys.stdout
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_row(self, row_out):
+        """ Buffers a row given as a list of fields. """
+        row = ';'.join(row_out)
+        self.rows.append(row)
+        self.size = self.size + len(row) + 1
+        if self.size >= self.block_size:
+            self.flush()
+
+    def write(self, data):
+        """ Buffers already formatted rows, "\n" included. """
+        if not data:
+            return
+        self.flush()
+        self.fp.write(data)
+
+    def flush(self):
+        if self.rows:
+            rows = self.rows
+            self.rows = []
+            self.size = 0
+            rows.append("")
+            self.fp.write("\n".join(rows))
+
+    def close(self):
+        self.flush()
+        if self.fp is sys.stdout:
+            self.fp.flush()
+        else:
+            self.fp.close()
+
+
+def convert_records(runner, records, batch_size, write_row):
+    """
+    Converts the records with runner, output rows are passed to write_row.
+    Returns None, or the failing record, runner.count being its line number.
+    """
+    if batch_size <= 1:
+        for line_in in records:
             try:
-                row = f.next()
-            except StopIteration:
-                return 0
-        return len(row.rstrip().split(";"))
+                row_out = runner.run(line_in)
+            except Exception:
+                return line_in
+            write_row(row_out)
+        return None
+
+    while True:
+        lines = list(islice(records, batch_size))
+        if not lines:
+            return None
+
+        count = runner.count
+        try:
+            rows_out = runner.run_batch(lines)
+        except Exception:
+            # Row by row to find the failing record
+            runner.count = count
+            for line_in in lines:
+                try:
+                    row_out = runner.run(line_in)
+                except Exception:
+                    return line_in
+                write_row(row_out)
+            raise
+
+        for row_out in rows_out:
+            write_row(row_out)
+
+
+# ActionPlan of the pool worker process
+_chunk_runner = None
+_chunk_batch_size = 0
+
+
+def init_chunk_worker(action_descs, batch_size):
+    global _chunk_runner, _chunk_batch_size
+    _chunk_runner = Transformer.create_plan(action_descs, batch_size)
+    _chunk_batch_size = batch_size
+
+
+def transform_chunk(chunk):
+    """
+    Transforms a byte range of the input file.
+    Returns the output, the number of converted rows and the failing row.
+    """
+    path_input, start, end = chunk
+    _chunk_runner.count = 0
+
+    rows_out = []
+    with MappedReader(path_input, start, end) as reader:
+        error_line = convert_records(_chunk_runner, reader.records(min_length=3),
+                                     _chunk_batch_size, rows_out.append)
+
+    output = "".join(["%s\n" % ';'.join(row_out) for row_out in rows_out])
+    return output, _chunk_runner.count, error_line
 
 
 class ActionRunner(object):
@@ -200,6 +490,393 @@ class ActionRunner(object):
         pass
 
 
+class ActionPlan(object):
+    """
+    Compiled form of ActionRunner.
+
+    The ActionDesc map is turned once per run into a flat list of prebound
+    column converters, so rows no longer pay for the string dispatch of
+    actions and the recomputation of the type flags.
+
+    Columns are then grouped into segments: runs of untouched columns are
+    copied as one slice of the record, only converted columns are sliced
+    into values, and fields are located up to the last converted column.
+    """
+
+    def __init__(self, action_descs):
+        self.nb_actions = len(action_descs)
+        self.count = 0
+
+        self.compilers_avails = {
+            "none": self.compile_none,
+            "ignore": self.compile_ignore,
+            "type": self.compile_type,
+            "size": self.compile_size,
+            "nb_decs": self.compile_none,
+            "move_before": self.compile_none,
+            "move_after": self.compile_none,
+        }
+
+        self.converters = []
+        self.ignored = set()
+        self.batch_specs = {}
+        for i in xrange(0, self.nb_actions):
+            self.compile_column(action_descs[i])
+
+        self.compile_segments()
+
+    def compile_column(self, action_desc):
+        """ Appends the converters of the column, in changes order. """
+        for chg in action_desc.changes_list:
+            converter = self.compilers_avails[chg](action_desc)
+            if converter is not None:
+                self.converters.append((action_desc.idx, converter))
+
+    def compile_segments(self):
+        """
+        Builds (kind, first_idx, last_idx, converters) segments up to the
+        last converted or ignored column, kind is one of copy/conv/drop.
+        """
+        converters_by_idx = {}
+        for idx, converter in self.converters:
+            converters_by_idx.setdefault(idx, []).append(converter)
+
+        needed = set(converters_by_idx) | self.ignored
+        self.last_needed = max(needed) if needed else -1
+
+        self.segments = []
+        for i in xrange(0, self.last_needed + 1):
+            if i in needed:
+                kind = "drop" if i in self.ignored else "conv"
+                self.segments.append((kind, i, i, converters_by_idx.get(i, [])))
+            elif self.segments and self.segments[-1][0] == "copy":
+                self.segments[-1] = ("copy", self.segments[-1][1], i, [])
+            else:
+                self.segments.append(("copy", i, i, []))
+
+    def compile_none(self, action_desc):
+        """ Nothing to do at row time. """
+        return None
+
+    def compile_ignore(self, action_desc):
+        self.ignored.add(action_desc.idx)
+        return None
+
+    def compile_type(self, action_desc):
+        """
+        Same managed cases as ActionRunner.action_type.
+        """
+        types = (action_desc.type_old, action_desc.type_new)
+        name = "C-%s" % (action_desc.idx + 1)
+
+        if types == ("T_DATE_8", "T_DATE_DB2"):
+            self.batch_specs[action_desc.idx] = ("db2", name)
+
+            def converter(value):
+                return ColumnDict.db2_value(value, name)
+            return converter
+
+        if types == ("T_NUM_V4", "T_NUM") or types == ("T_NUM", "T_NUM"):
+            size_old = action_desc.size_old
+            size_new = action_desc.size_new
+            nb_decs_old = action_desc.nb_decs_old
+            nb_decs_new = action_desc.nb_decs_new
+            self.batch_specs[action_desc.idx] = ("num", name, size_old, size_new,
+                                                 nb_decs_old, nb_decs_new)
+
+            def converter(value):
+                return ColumnDict.num_value(value, name, size_old, size_new,
+                                            nb_decs_old, nb_decs_new)
+            return converter
+
+        return None
+
+    def compile_size(self, action_desc):
+        """
+        Same managed cases as ActionRunner.action_size.
+        """
+        if action_desc.type_old != "T_TEXT" or action_desc.chg_type:
+            return None
+
+        count = abs(action_desc.size_new - action_desc.size_old)
+        if action_desc.size_strip == "R":
+            return lambda value: ColumnDict.rtrim_value(value, count)
+        elif action_desc.size_strip == "L":
+            return lambda value: ColumnDict.ltrim_value(value, count)
+        return lambda value: ColumnDict.auto_trim_value(value, count)
+
+    def locate(self, line_in):
+        """
+        Counts the row and checks its number of columns.
+        Returns bounds: column i is line_in[bounds[i]:bounds[i + 1] - 1].
+        """
+        self.count = self.count + 1
+        length = line_in.count(";") + 1
+
+        if length < self.nb_actions:
+            raise Exception, "[E] Line %s: Invalid number of columns: %s, expected: %s" % (self.count, length, self.nb_actions)
+
+        bounds = [0]
+        pos = 0
+        find = line_in.find
+        for i in xrange(0, self.last_needed + 1):
+            pos = find(";", pos)
+            if pos == -1:
+                pos = len(line_in)
+            pos = pos + 1
+            bounds.append(pos)
+        return bounds
+
+    def run(self, line_in):
+        """
+        Applies the compiled segments to the row.
+        Returns the output row as a list of fields and column runs.
+        """
+        bounds = self.locate(line_in)
+
+        row_out = []
+        for kind, first, last, converters in self.segments:
+            if kind == "copy":
+                row_out.append(line_in[bounds[first]:bounds[last + 1] - 1])
+                continue
+
+            value = line_in[bounds[first]:bounds[first + 1] - 1]
+            for converter in converters:
+                value = converter(value)
+            if kind == "conv":
+                row_out.append(value)
+
+        # Untouched columns after the last converted one
+        if bounds[-1] <= len(line_in):
+            row_out.append(line_in[bounds[-1]:])
+        return row_out
+
+    def replay(self, line_in, line_number):
+        """
+        Converts again a failing row as row number line_number,
+        so that its error is raised with this line number.
+        """
+        self.count = line_number - 1
+        self.run(line_in)
+        raise Exception, "[E] Line %s: conversion failed." % line_number
+
+
+class BatchPlan(ActionPlan):
+    """
+    Columnar form of ActionPlan.
+
+    Rows are converted by batches: the values of each converted column are
+    gathered into a column batch, numeric and date columns are converted by
+    the ColumnBatch kernels, other columns by the ActionPlan converters.
+    The output is the same as ActionPlan.run, row by row.
+    """
+
+    def run_batch(self, lines):
+        """
+        Converts a list of rows.
+        Errors are raised for the batch, the rows are then to be replayed
+        with ActionPlan.run to get the row engine error.
+        """
+        rows_out = []
+        batches = [[] for segment in self.segments]
+        positions = []
+
+        for line_in in lines:
+            bounds = self.locate(line_in)
+
+            row_out = []
+            for j, (kind, first, last, converters) in enumerate(self.segments):
+                if kind == "copy":
+                    row_out.append(line_in[bounds[first]:bounds[last + 1] - 1])
+                    continue
+
+                batches[j].append(line_in[bounds[first]:bounds[first + 1] - 1])
+                if kind == "conv":
+                    row_out.append(None)
+
+            if bounds[-1] <= len(line_in):
+                row_out.append(line_in[bounds[-1]:])
+            rows_out.append(row_out)
+
+        # Position of each converted column in the output rows
+        pos = 0
+        for j, (kind, first, last, converters) in enumerate(self.segments):
+            if kind == "drop":
+                positions.append(None)
+            else:
+                positions.append(pos)
+                pos = pos + 1
+
+        for j, (kind, first, last, converters) in enumerate(self.segments):
+            if kind == "copy":
+                continue
+
+            values = self.convert_batch(first, converters, batches[j])
+            if kind == "conv":
+                pos = positions[j]
+                for row_out, value in zip(rows_out, values):
+                    row_out[pos] = value
+
+        return rows_out
+
+    def convert_batch(self, idx, converters, values):
+        spec = self.batch_specs.get(idx)
+        if spec is not None and len(converters) == 1:
+            if spec[0] == "num":
+                return ColumnBatch.num_values(values, *spec[1:])
+            return ColumnBatch.db2_values(values, *spec[1:])
+
+        for converter in converters:
+            values = [converter(value) for value in values]
+        return values
+
+
+class ColumnBatch(object):
+    """
+    Column kernels of BatchPlan.
+
+    With NumPy, the cells of the usual fixed-width layout are converted as
+    one uint8 matrix. Other cells, and all cells without NumPy, go through
+    the ColumnDict row converters, which also raise the errors.
+    """
+
+    WHITESPACES = [ord(c) for c in " \t\n\v\f\r"]
+
+    @staticmethod
+    def as_matrix(values, width):
+        """
+        Returns the values as a (len, width) uint8 matrix, and the mask
+        of the values of this exact width.
+        """
+        lengths = numpy.fromiter((len(value) for value in values),
+                                 dtype=numpy.int64, count=len(values))
+        matrix = numpy.array(values, dtype="S%s" % width)
+        matrix = matrix.view(numpy.uint8).reshape(len(values), width)
+        return matrix, lengths == width
+
+    @staticmethod
+    def as_strings(matrix):
+        width = matrix.shape[1]
+        if width == 0:
+            return [""] * matrix.shape[0]
+        return numpy.ascontiguousarray(matrix).view("S%s" % width).ravel().tolist()
+
+    @staticmethod
+    def merge(values, fast_mask, fast_values, slow_converter):
+        """
+        Takes the kernel result where fast_mask is set, and the row
+        converter result elsewhere, in row order.
+        """
+        results = []
+        fast = iter(fast_values)
+        for value, is_fast in zip(values, fast_mask.tolist()):
+            if is_fast:
+                results.append(next(fast))
+            else:
+                results.append(slow_converter(value))
+        return results
+
+    @staticmethod
+    def db2_values(values, name):
+        """ Batch form of ColumnDict.db2_value. """
+        slow_converter = lambda value: ColumnDict.db2_value(value, name)
+        if numpy is None or not values:
+            return [slow_converter(value) for value in values]
+
+        matrix, mask = ColumnBatch.as_matrix(values, 8)
+
+        # Dates without surrounding whitespaces, or blank dates
+        is_blank = (matrix == 32).all(axis=1)
+        edges = numpy.in1d(matrix[:, [0, 7]], ColumnBatch.WHITESPACES)
+        is_date = ~edges.reshape(len(values), 2).any(axis=1)
+        mask = mask & (is_date | is_blank) & (matrix != 0).all(axis=1)
+
+        out = numpy.empty((len(values), 10), dtype=numpy.uint8)
+        out[:, 0:4] = matrix[:, 0:4]
+        out[:, 4] = ord("-")
+        out[:, 5:7] = matrix[:, 4:6]
+        out[:, 7] = ord("-")
+        out[:, 8:10] = matrix[:, 6:8]
+        out[is_blank] = 32
+
+        return ColumnBatch.merge(values, mask, ColumnBatch.as_strings(out[mask]),
+                                 slow_converter)
+
+    @staticmethod
+    def num_values(values, name, size_old, size_new, nb_decs_old, nb_decs_new):
+        """
+        Batch form of ColumnDict.num_value.
+
+        Kernel cells are blank cells, and cells made of spaces, an optional
+        "-", digits, a "," or "." separator and nb_decs_old digits.
+        """
+        slow_converter = lambda value: ColumnDict.num_value(
+            value, name, size_old, size_new, nb_decs_old, nb_decs_new)
+        sep_idx = size_old - nb_decs_old - 1
+        int_size = size_new - 2 - nb_decs_new
+        if numpy is None or not values or nb_decs_old < 1 or sep_idx < 1 \
+           or int_size < 0:
+            return [slow_converter(value) for value in values]
+
+        nb_rows = len(values)
+        matrix, mask = ColumnBatch.as_matrix(values, size_old)
+
+        is_digit = (matrix >= 48) & (matrix <= 57)
+        is_space = matrix == 32
+        is_minus = matrix == 45
+        is_sep = (matrix == 44) | (matrix == 46)
+
+        is_blank = (is_space | is_minus | is_sep).all(axis=1)
+
+        # Integer part: spaces, an optional "-", then digits
+        int_digit = is_digit[:, :sep_idx]
+        int_nonspace = ~is_space[:, :sep_idx]
+        started = numpy.cumsum(int_nonspace, axis=1) > 0
+        started_before = numpy.cumsum(int_nonspace, axis=1) - int_nonspace > 0
+        is_int_valid = (int_digit | is_space[:, :sep_idx] | is_minus[:, :sep_idx]).all(axis=1) \
+                       & ~(started & is_space[:, :sep_idx]).any(axis=1) \
+                       & ~(started_before & is_minus[:, :sep_idx]).any(axis=1) \
+                       & int_digit[:, -1]
+        is_neg = is_minus[:, :sep_idx].any(axis=1)
+
+        is_num = is_int_valid & is_sep[:, sep_idx] \
+                 & is_digit[:, sep_idx + 1:].all(axis=1)
+
+        # Significant digits of the integer part, "0" counts as one
+        significant = int_digit & (matrix[:, :sep_idx] != 48)
+        has_significant = significant.any(axis=1)
+        first_significant = numpy.where(has_significant,
+                                        numpy.argmax(significant, axis=1),
+                                        sep_idx - 1)
+        int_len = sep_idx - first_significant
+
+        is_full_positive = (int_len == int_size + 1) & ~is_neg
+        is_num = is_num & ((int_len <= int_size) | is_full_positive)
+        mask = mask & (is_blank | is_num)
+
+        # Output: sign, zero padded integer part, ",", decimals
+        out = numpy.empty((nb_rows, size_new), dtype=numpy.uint8)
+        out.fill(48)
+        digits = numpy.where(int_digit, matrix[:, :sep_idx], 48).astype(numpy.uint8)
+
+        width = min(int_size, sep_idx)
+        if width > 0:
+            out[:, 1 + int_size - width:1 + int_size] = digits[:, sep_idx - width:]
+        out[:, 0] = numpy.where(is_neg, 45, 32)
+        if int_size + 1 <= sep_idx:
+            full = digits[:, sep_idx - int_size - 1:]
+            out[is_full_positive, 0:int_size + 1] = full[is_full_positive]
+
+        out[:, int_size + 1] = 44
+        nb_decs = min(nb_decs_old, nb_decs_new)
+        out[:, int_size + 2:int_size + 2 + nb_decs] = \
+            matrix[:, sep_idx + 1:sep_idx + 1 + nb_decs]
+        out[is_blank] = 32
+
+        return ColumnBatch.merge(values, mask, ColumnBatch.as_strings(out[mask]),
+                                 slow_converter)
+
+
 class ColumnDict(object):
     REMOVED = "---"
 
@@ -217,41 +894,61 @@ class ColumnDict(object):
         self.length = i
 
     def rtrim(self, idx, count):
-        self.col_values[idx] = self.col_values[idx][:-count]
+        self.col_values[idx] = self.rtrim_value(self.col_values[idx], count)
 
     def ltrim(self, idx, count):
-        self.col_values[idx] = self.col_values[idx][count:]
+        self.col_values[idx] = self.ltrim_value(self.col_values[idx], count)
 
     def auto_trim(self, idx, count):
-        value = self.col_values[idx]
-        if value[0:count-1].strip() == "":
-            self.ltrim(idx, count)
-        else:
-            self.rtrim(idx, count)
+        self.col_values[idx] = self.auto_trim_value(self.col_values[idx], count)
 
     def conv_to_db2(self, idx):
-        value = self.col_values[idx].strip()
-        if value == "":
-            self.col_values[idx] = " " * 10
-            return
-
-        self.check(len(value) == 8, idx)
-        self.col_values[idx] = "%s-%s-%s" % (value[0:4], value[4:6], value[6:])
+        self.col_values[idx] = self.db2_value(self.col_values[idx],
+                                              self.col_names[idx])
 
     def conv_between_num(self, idx, size_old, size_new, nb_decs_old, nb_decs_new):
         self.conv_to_num(idx, size_old, size_new, nb_decs_old, nb_decs_new)
 
     def conv_to_num(self, idx, size_old, size_new, nb_decs_old, nb_decs_new):
-        value = self.col_values[idx].replace(".", ",")
+        self.col_values[idx] = self.num_value(self.col_values[idx],
+                                              self.col_names[idx],
+                                              size_old, size_new,
+                                              nb_decs_old, nb_decs_new)
+
+    @staticmethod
+    def rtrim_value(value, count):
+        return value[:-count]
+
+    @staticmethod
+    def ltrim_value(value, count):
+        return value[count:]
+
+    @staticmethod
+    def auto_trim_value(value, count):
+        if value[0:count-1].strip() == "":
+            return value[count:]
+        return value[:-count]
+
+    @staticmethod
+    def db2_value(value_in, name):
+        value = value_in.strip()
+        if value == "":
+            return " " * 10
+
+        check_value(len(value) == 8, name, value_in)
+        return "%s-%s-%s" % (value[0:4], value[4:6], value[6:])
+
+    @staticmethod
+    def num_value(value_in, name, size_old, size_new, nb_decs_old, nb_decs_new):
+        value = value_in.replace(".", ",")
 
         if value.replace(",", "").replace("-", "").strip() == "":
-            self.col_values[idx] = " " * size_new
-            return
+            return " " * size_new
 
-        self.check(len(value) == size_old, idx)
-        self.check(value[-nb_decs_old-1] == ",", idx)
-        self.check(value.count("-") < 2, idx)
-        self.check(value.count(",") == 1, idx)
+        check_value(len(value) == size_old, name, value_in)
+        check_value(value[-nb_decs_old-1] == ",", name, value_in)
+        check_value(value.count("-") < 2, name, value_in)
+        check_value(value.count(",") == 1, name, value_in)
 
         comma_idx = value.find(",")
         neg_idx = value[0:comma_idx].find("-")
@@ -268,8 +965,8 @@ class ColumnDict(object):
         if int_part == "": int_part = "0"
         if dec_part == "": dec_part = "0"
 
-        self.check(int_part.isdigit(), idx)
-        self.check(dec_part.isdigit(), idx)
+        check_value(int_part.isdigit(), name, value_in)
+        check_value(dec_part.isdigit(), name, value_in)
 
         # ### Convert !
 
@@ -279,7 +976,7 @@ class ColumnDict(object):
         # case of the positive int wich fills all size
         is_full_positive_int = int_offset_add == -1 and neg_idx == -1
 
-        self.check(int_offset_add >= 0 or is_full_positive_int, idx)
+        check_value(int_offset_add >= 0 or is_full_positive_int, name, value_in)
 
         if dec_offset_add > 0:
             dec_part = dec_part + "0" * abs(dec_offset_add)
@@ -291,7 +988,7 @@ class ColumnDict(object):
             if neg_idx != -1: int_part =  "-" + int_part
             else: int_part =  " " + int_part
 
-        self.col_values[idx] = int_part + "," + dec_part
+        return int_part + "," + dec_part
 
 
     def ignore(self, idx):
@@ -316,8 +1013,12 @@ class ColumnDict(object):
         return results
 
     def check(self, condition, idx):
-        if not condition:
-            raise Exception, "[E] [%s=\"%s\"] - bad value." % (self.col_names[idx], self.col_values[idx])
+        check_value(condition, self.col_names[idx], self.col_values[idx])
+
+
+def check_value(condition, name, value):
+    if not condition:
+        raise Exception, "[E] [%s=\"%s\"] - bad value." % (name, value)
 
 
 class ActionDesc(object):
@@ -422,6 +1123,48 @@ class ActionDesc(object):
         return int(name[2:]) - 1
 
 
+# --- Benchmark ----------------------------------------------------------------
+
+def bench(path_format, path_input, batch_size=0):
+    """
+    Compares ActionRunner and ActionPlan, and BatchPlan when batch_size is
+    given, on the same format and input.
+    Outputs are compared row by row, nothing is written.
+    """
+    transformer = Transformer(path_format, path_input, None)
+    transformer.load_format()
+    if transformer.real_max_cols == 0: return
+
+    engines = [("ActionRunner", ActionRunner(transformer.action_descs), 0),
+               ("ActionPlan", ActionPlan(transformer.action_descs), 0)]
+    if batch_size > 1:
+        engines.append(("BatchPlan", BatchPlan(transformer.action_descs), batch_size))
+    timings = {}
+    outputs = {}
+
+    for engine_name, runner, engine_batch_size in engines:
+        rows_out = []
+        start = time.time()
+        with open(path_input, "rb") as fin:
+            records = (line_in.rstrip("\n") for line_in in fin if len(line_in) >= 3)
+            error_line = convert_records(runner, records, engine_batch_size,
+                                         lambda row_out: rows_out.append(';'.join(row_out)))
+        if error_line is not None:
+            runner.replay(error_line, runner.count)
+        timings[engine_name] = time.time() - start
+        outputs[engine_name] = rows_out
+
+    for engine_name, runner, engine_batch_size in engines[1:]:
+        if outputs["ActionRunner"] != outputs[engine_name]:
+            raise Exception, "[E] %s output differs from ActionRunner output." % engine_name
+
+    nb_rows = len(outputs["ActionRunner"])
+    for engine_name, runner, engine_batch_size in engines:
+        print("%-12s: %8.3fs (%s rows) x%.2f" % (engine_name, timings[engine_name], nb_rows,
+                                                timings["ActionRunner"] / max(timings[engine_name], 1e-9)),
+              file=sys.stderr)
+
+
 # --- Main ---------------------------------------------------------------------
 
 def main(options, args):
@@ -431,12 +1174,16 @@ def main(options, args):
     '''
 
     # Get Args
-    path_format, path_input, path_output = args
-    if not path_output:
-        path_output = sys.stdout
+    path_format, path_input, path_output = (tuple(args) + (None,))[:3]
 
+    if options.bench:
+        bench(path_format, path_input, options.batch_size)
+        return
     # Run
-    transformer = Transformer(path_format, path_input, path_output)
+    transformer = Transformer(path_format, path_input, path_output,
+                              jobs=options.jobs,
+                              block_size=options.block_size,
+                              batch_size=options.batch_size)
     transformer.run()
 
 
@@ -444,6 +1191,30 @@ if __name__ == '__main__':
     usage = "Usage: %prog <format_file> <input-file> [output-file]"
     parser = OptionParser(usage=usage, version=__version__)
 
+    # Benchmark
+    parser.add_option("--bench",
+                      action="store_const", const=1, default=0,
+                      dest="bench",
+                      help="Compare ActionRunner and ActionPlan timings")
+
+    # Multi-process mode
+    parser.add_option("-j", "--jobs",
+                      action="store", type="int", default=1,
+                      dest="jobs", metavar="N",
+                      help="Transform input chunks in N processes")
+
+    # Output block size
+    parser.add_option("-B", "--block-size",
+                      action="store", type="int", default=BulkWriter.BLOCK_SIZE,
+                      dest="block_size", metavar="BYTES",
+                      help="Flush output in blocks of BYTES (default: %default)")
+
+    # Columnar engine
+    parser.add_option("-n", "--batch",
+                      action="store", type="int", default=0,
+                      dest="batch_size", metavar="N",
+                      help="Convert by columnar batches of N rows")
+
     (options, args) = parser.parse_args()
 
     if len(sys.argv) <= 1:
@@ -4,43 +4,694 @@ import sys
 from optparse import OptionParser
 import json
 import codecs
+import gzip
+import hashlib
+import mmap
+import os
+import re
+import multiprocessing
+from collections import deque
+from itertools import islice
 
 
-def run(egrep, file_path):
+class TermMatcher(object):
+    '''
+    Finds the terms contained in a line, scanning it once whatever the
+    number of terms: a lookahead regex built from the terms trie yields
+    the longest term starting at each position, the terms it contains
+    are then added, so overlapping terms are all found.
+    '''
 
+    def __init__(self, terms):
+        # latin-1 terms, as lines are read
+        self.terms = {}
+        for term in terms:
+            key = term.decode('latin-1') if isinstance(term, str) else term
+            self.terms[key] = term
+        self.always = set(term for key, term in self.terms.items() if not key)
+        self.contained = {}
+
+        trie = {}
+        for key in self.terms:
+            if key:
+                node = trie
+                for char in key:
+                    node = node.setdefault(char, {})
+                node[''] = {}
+        self.regex = None
+        if trie:
+            self.regex = re.compile('(?=(%s))' % self.trie_pattern(trie))
+
+    def trie_pattern(self, node):
+        branches = [re.escape(char) + self.trie_pattern(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1:
+            pattern = branches[0]
+        else:
+            pattern = '(?:%s)' % '|'.join(branches)
+        # a term ends here, longer terms are tried first
+        if '' in node:
+            pattern = '(?:%s)?' % pattern
+        return pattern
+
+    def find(self, line):
+        found = set(self.always)
+        if self.regex is None:
+            return found
+        for match in self.regex.finditer(line):
+            key = match.group(1)
+            if key not in self.contained:
+                self.contained[key] = set(term for other, term
+                                          in self.terms.items()
+                                          if other and other in key)
+            found.update(self.contained[key])
+        return found
+
+    def find_lines(self, data, start=0, end=None):
+        '''
+        Yields the (start, end) bounds, newline excluded, of the lines of
+        data[start:end] containing a term. data may be a mmap, the regex
+        skipping lines without terms.
+        '''
+        if end is None:
+            end = len(data)
+        pos = start
+        while pos < end:
+            if self.always:
+                line_start = pos
+            else:
+                match = self.regex.search(data, pos, end) if self.regex else None
+                if match is None:
+                    return
+                line_start = max(data.rfind('\n', pos, match.start()) + 1, pos)
+                pos = match.start()
+            line_end = data.find('\n', pos, end)
+            if line_end < 0:
+                line_end = end
+            yield line_start, line_end
+            pos = line_end + 1
+
+
+def run(egrep, file_path, counts=False):
+    '''
+    Groups grep output lines by egrep term.
+    With counts, each term gets its hit count and the byte offsets of its
+    lines in file_path, instead of the lines.
+    '''
     matches = egrep.split('|')
-    results = {}
+    hits = {}
+    nb_matches = {}
     for match in matches:
-        results[match] = ''
+        hits[match] = []
+        nb_matches[match] = nb_matches.get(match, 0) + 1
+    matcher = TermMatcher(matches)
+    offset = 0
     with codecs.open(file_path, "r", encoding='latin-1') as f_in:
         for line in f_in:
             line_in = line.rstrip('\r\n').rstrip('\n')
+            # latin-1: one byte per character
+            line_offset = offset
+            offset += len(line)
             res = line_in.split(':', 1)
             if len(res) < 2:
                 continue
             path, expr = tuple(res)
-            for match in matches:
-                if match in expr:
-                    results[match] = "%s\n%s" % (results[match], line_in)
+            hit = line_offset if counts else line_in
+            for match in matcher.find(expr):
+                # repeated terms are grouped as many times
+                hits[match].extend([hit] * nb_matches[match])
+
+    print_results(matches, hits, counts)
+
+
+def print_results(matches, hits, counts=False):
+    results = {}
+    for match in hits:
+        if counts:
+            results[match] = {"count": len(hits[match]),
+                              "offsets": hits[match]}
+        else:
+            results[match] = "".join("\n%s" % line_in
+                                     for line_in in hits[match])
 
     print json.dumps(results, sort_keys=True,
                      indent=4, separators=(',', ': '))
     print "Not FOUND:"
     for match in matches:
-        if len(results[match]) < 2:
+        if counts and not hits[match] or \
+                not counts and len(results[match]) < 2:
             print '    %s' % match
 
 
+CHUNK_SIZE = 8 * 1024 * 1024
+GROUP_SIZE = 1000
+
+
+def run_stream(egrep, file_paths, jobs=1, counts=False, group_size=GROUP_SIZE):
+    '''
+    Groups the lines of several grep outputs, "-" being stdin, by egrep
+    term and writes the groups as newline-delimited JSON, a group being
+    written once it holds group_size hits. Chunks of the inputs are
+    grouped by jobs processes.
+    '''
+    matches = egrep.split('|')
+    writer = GroupWriter(matches, counts, group_size)
+    group_chunks(iter_chunks(file_paths or ['-']), matches, counts, jobs,
+                 writer)
+
+
+def run_search(egrep, paths, jobs=1, counts=False, ndjson=False,
+               group_size=GROUP_SIZE, state_path=None):
+    '''
+    Searches the egrep terms in log files and directory trees, gzip files
+    included, and groups the matching lines as "<path>:<line>", as
+    grep would output them.
+    Terms are literal strings, as for grouping.
+    With state_path, only the lines appended since the previous run are
+    searched, see SearchState.
+    '''
+    matches = egrep.split('|')
+    if ndjson:
+        writer = GroupWriter(matches, counts, group_size)
+    else:
+        writer = ResultsWriter(matches, counts)
+    state = None
+    if state_path is not None:
+        state = SearchState(state_path, egrep)
+        writer = StateWriter(writer, state)
+    group_chunks(iter_log_chunks(paths, state=state), matches, counts, jobs,
+                 writer)
+
+
+def group_chunks(chunks, matches, counts, jobs, writer):
+    '''
+    Groups chunks with group_chunk, in jobs processes, and adds the groups
+    to writer in chunks order.
+    '''
+    if jobs <= 1:
+        init_group_worker(matches, counts)
+        for chunk in chunks:
+            writer.add(chunk[0], group_chunk(chunk))
+        writer.close()
+        return
+
+    pool = multiprocessing.Pool(jobs, init_group_worker, (matches, counts))
+
+    # At most 2 chunks per job are pending
+    pending = deque()
+    try:
+        for chunk in islice(chunks, jobs * 2):
+            pending.append((chunk[0],
+                            pool.apply_async(group_chunk, (chunk,))))
+
+        while pending:
+            file_path, result = pending.popleft()
+            writer.add(file_path, result.get())
+
+            for chunk in islice(chunks, 1):
+                pending.append((chunk[0],
+                                pool.apply_async(group_chunk, (chunk,))))
+    finally:
+        pool.close()
+        pool.join()
+    writer.close()
+
+
+def iter_chunks(file_paths, chunk_size=CHUNK_SIZE):
+    '''
+    Yields newline-aligned (file_path, start, end, data, kind) chunks of
+    grep outputs, data being read by the worker for files and read here
+    for stdin.
+    '''
+    for file_path in file_paths:
+        if file_path == '-':
+            start = 0
+            for data in iter_blocks(sys.stdin, chunk_size):
+                yield file_path, start, start + len(data), data, 'grep'
+                start = start + len(data)
+            continue
+
+        for start, end in split_file(file_path, chunk_size):
+            yield file_path, start, end, None, 'grep'
+
+
+def iter_log_chunks(paths, chunk_size=CHUNK_SIZE, state=None):
+    '''
+    Yields the chunks of the log files found in paths, a gzip file being
+    a single chunk.
+    With state, chunks start at the offset of the previous run and end at
+    the last complete line, the new offsets being recorded in state.
+    '''
+    for file_path in iter_log_files(paths):
+        stat = os.stat(file_path)
+        with open(file_path, "rb") as f:
+            is_gzip = f.read(2) == '\x1f\x8b'
+        start = 0
+        end = stat.st_size
+        if is_gzip:
+            if state is not None:
+                start = state.get_gzip_start(file_path, stat)
+                state.set_end(file_path, stat, end)
+            if start is not None:
+                yield file_path, start, None, None, 'gzip'
+            continue
+
+        if state is not None:
+            head = read_head(file_path, stat)
+            start = state.get_start(file_path, stat, head)
+            end = last_line_end(file_path, start, end)
+            state.set_end(file_path, stat, end, head)
+        for chunk_start, chunk_end in split_file(file_path, chunk_size,
+                                                 start, end):
+            yield file_path, chunk_start, chunk_end, None, 'log'
+
+
+def iter_log_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(dir_path, file_name)
+                if os.path.isfile(file_path):
+                    yield file_path
+
+
+def split_file(file_path, chunk_size=CHUNK_SIZE, start=0, size=None):
+    '''
+    Yields the (start, end) bounds of newline-aligned chunks of file_path,
+    from start to size.
+    '''
+    with open(file_path, "rb") as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        while start < size:
+            if start + chunk_size < size:
+                f.seek(start + chunk_size)
+                f.readline()
+                end = min(f.tell(), size)
+            else:
+                end = size
+            yield start, end
+            start = end
+
+
+def last_line_end(file_path, start, end, block_size=64 * 1024):
+    '''
+    Returns the offset following the last newline of file_path between
+    start and end, start if there is none.
+    '''
+    with open(file_path, "rb") as f:
+        pos = end
+        while pos > start:
+            block_start = max(start, pos - block_size)
+            f.seek(block_start)
+            idx = f.read(pos - block_start).rfind('\n')
+            if idx >= 0:
+                return block_start + idx + 1
+            pos = block_start
+    return start
+
+
+def read_head(file_path, stat, head_size=64 * 1024):
+    '''
+    Returns the first bytes of file_path, up to head_size.
+    '''
+    with open(file_path, "rb") as f:
+        return f.read(min(head_size, stat.st_size))
+
+
+def iter_blocks(f, block_size=CHUNK_SIZE):
+    '''
+    Yields newline-aligned blocks read from f.
+    '''
+    data = f.read(block_size)
+    while data:
+        yield data + f.readline()
+        data = f.read(block_size)
+
+
+_group_matcher = None
+_group_nb_matches = None
+_group_counts = False
+
+
+def init_group_worker(matches, counts):
+    global _group_matcher, _group_nb_matches, _group_counts
+    _group_matcher = TermMatcher(matches)
+    _group_nb_matches = {}
+    for match in matches:
+        _group_nb_matches[match] = _group_nb_matches.get(match, 0) + 1
+    _group_counts = counts
+
+
+def group_chunk(chunk):
+    '''
+    Groups the lines of a chunk by term.
+    Returns the lines, or their byte offset with counts, of each term.
+    '''
+    file_path, start, end, data, kind = chunk
+    if kind == 'gzip':
+        groups = {}
+        f = gzip.open(file_path, "rb")
+        try:
+            # offsets in the uncompressed data
+            f.seek(start)
+            offset = start
+            for data in iter_blocks(f):
+                group_log_lines(file_path, data, 0, len(data), offset, groups)
+                offset = offset + len(data)
+        finally:
+            f.close()
+        return groups
+
+    if kind == 'log':
+        groups = {}
+        with open(file_path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                group_log_lines(file_path, data, start, end, 0, groups)
+            finally:
+                data.close()
+        return groups
+
+    if data is None:
+        with open(file_path, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start)
+
+    groups = {}
+    offset = start
+    for line in data.split('\n'):
+        line_offset = offset
+        offset = offset + len(line) + 1
+        line_in = line.rstrip('\r').decode('latin-1')
+        res = line_in.split(':', 1)
+        if len(res) < 2:
+            continue
+        path, expr = tuple(res)
+        hit = line_offset if _group_counts else line_in
+        for match in _group_matcher.find(expr):
+            # repeated terms are grouped as many times
+            groups.setdefault(match, []).extend([hit] * _group_nb_matches[match])
+    return groups
+
+
+def group_log_lines(file_path, data, start, end, offset, groups):
+    '''
+    Adds the lines of data[start:end] containing terms to groups,
+    as "<file_path>:<line>" or their offset + line start with counts.
+    '''
+    path_in = file_path.decode('latin-1')
+    for line_start, line_end in _group_matcher.find_lines(data, start, end):
+        line_in = data[line_start:line_end].rstrip('\r').decode('latin-1')
+        hit = offset + line_start if _group_counts else \
+            u"%s:%s" % (path_in, line_in)
+        for match in _group_matcher.find(line_in):
+            # repeated terms are grouped as many times
+            groups.setdefault(match, []).extend([hit] * _group_nb_matches[match])
+
+
+class ResultsWriter(object):
+    '''
+    Collects the groups of all chunks and prints them as run does, offsets
+    being [file, offset] pairs with counts.
+    '''
+
+    def __init__(self, matches, counts=False):
+        self.matches = matches
+        self.counts = counts
+        self.hits = dict((match, []) for match in matches)
+
+    def add(self, file_path, groups):
+        for match, hits in groups.iteritems():
+            if self.counts:
+                hits = [[file_path, offset] for offset in hits]
+            self.hits[match].extend(hits)
+
+    def close(self):
+        print_results(self.matches, self.hits, self.counts)
+
+
+class SearchState(object):
+    '''
+    Incremental search state, saved as JSON to state_path:
+        per log file, its device, inode and size, and the offset following
+        the last line searched, with the sha1 and size of its head for
+        plain files,
+        per term, the hit count and the latest hits of all runs.
+    A file is searched again from the start when its inode changed, unless
+    another file of the previous run had it (renamed by a rotation), when
+    it is smaller than its offset (truncated) or when its head changed
+    (rewritten, or a reused inode). Gzip files are
+    searched once, until their inode or size change. A new gzip file
+    starting with the head of a plain file of the previous run is that
+    file compressed by a rotation, it is searched from the offset of the
+    plain file.
+    The state is reset when the terms change.
+    '''
+    NB_SAMPLES = 10
+
+    def __init__(self, state_path, egrep):
+        self.path = state_path
+        self.egrep = egrep
+        self.files = {}
+        self.counts = {}
+        self.samples = {}
+        self.previous = {}
+        if os.path.isfile(state_path):
+            with open(state_path) as f:
+                data = json.load(f)
+            if data["egrep"] == egrep:
+                self.previous = data["files"]
+                self.counts = data["counts"]
+                self.samples = data["samples"]
+        self.inodes = dict(((entry["dev"], entry["inode"]), entry)
+                           for entry in self.previous.itervalues())
+        # plain files by head size
+        self.heads = {}
+        for entry in self.previous.itervalues():
+            if entry.get("head_size"):
+                self.heads.setdefault(entry["head_size"], []).append(entry)
+
+    def get_entry(self, file_path, stat):
+        '''
+        Returns the previous run entry of file_path, by path then by inode.
+        '''
+        entry = self.previous.get(file_path)
+        if entry is None or entry["inode"] != stat.st_ino or \
+                entry["dev"] != stat.st_dev:
+            entry = self.inodes.get((stat.st_dev, stat.st_ino))
+        return entry
+
+    def get_start(self, file_path, stat, head):
+        '''
+        Returns the offset to search file_path from, head being its first
+        bytes. The offset of the previous run is only kept if the file
+        still starts with the same head, inodes being reused and files
+        rewritten.
+        '''
+        entry = self.get_entry(file_path, stat)
+        if entry is None or stat.st_size < entry["offset"]:
+            return 0
+        if entry.get("head_size") and \
+                hashlib.sha1(head[:entry["head_size"]]).hexdigest() != \
+                entry["head"]:
+            return 0
+        return entry["offset"]
+
+    def get_gzip_start(self, file_path, stat):
+        '''
+        Returns the uncompressed offset to search the gzip file_path from,
+        None if it was searched.
+        '''
+        entry = self.get_entry(file_path, stat)
+        if entry is not None:
+            return None if stat.st_size == entry["size"] else 0
+        entry = self.get_compressed_entry(file_path)
+        if entry is None:
+            return 0
+        return entry["offset"]
+
+    def get_compressed_entry(self, file_path):
+        '''
+        Returns the entry of the plain file whose head starts the gzip
+        file_path, the longest head first.
+        '''
+        if not self.heads:
+            return None
+        f = gzip.open(file_path, "rb")
+        try:
+            data = f.read(max(self.heads))
+        except (IOError, EOFError):
+            return None
+        finally:
+            f.close()
+
+        for head_size in sorted(self.heads, reverse=True):
+            if len(data) < head_size:
+                continue
+            head = hashlib.sha1(data[:head_size]).hexdigest()
+            for entry in self.heads[head_size]:
+                if entry["head"] == head:
+                    return entry
+        return None
+
+    def set_end(self, file_path, stat, offset, head=None):
+        self.files[file_path] = {"dev": stat.st_dev, "inode": stat.st_ino,
+                                 "size": stat.st_size, "offset": offset}
+        if head:
+            self.files[file_path]["head"] = hashlib.sha1(head).hexdigest()
+            self.files[file_path]["head_size"] = len(head)
+
+    def add(self, groups):
+        for match, hits in groups.iteritems():
+            self.counts[match] = self.counts.get(match, 0) + len(hits)
+            samples = self.samples.get(match, []) + hits[-self.NB_SAMPLES:]
+            self.samples[match] = samples[-self.NB_SAMPLES:]
+
+    def save(self):
+        data = {"egrep": self.egrep, "files": self.files,
+                "counts": self.counts, "samples": self.samples}
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+class StateWriter(object):
+    '''
+    Adds groups to a SearchState before writing them with writer, the state
+    being saved once all groups are written.
+    '''
+
+    def __init__(self, writer, state):
+        self.writer = writer
+        self.state = state
+
+    def add(self, file_path, groups):
+        samples = groups
+        if self.writer.counts:
+            samples = dict((match, [[file_path, offset] for offset in hits])
+                           for match, hits in groups.iteritems())
+        self.state.add(samples)
+        self.writer.add(file_path, groups)
+
+    def close(self):
+        self.writer.close()
+        self.state.save()
+
+
+class GroupWriter(object):
+    '''
+    Merges chunk groups by term and writes them as JSON lines:
+        {"term": ..., "count": ..., "lines": [...]}
+    or with counts, per term and file:
+        {"term": ..., "file": ..., "count": ..., "offsets": [...]}
+    Terms without hits are written last with a 0 count.
+    '''
+
+    def __init__(self, matches, counts=False, group_size=GROUP_SIZE,
+                 f_out=sys.stdout):
+        self.matches = matches
+        self.counts = counts
+        self.group_size = group_size
+        self.f_out = f_out
+        self.pending = {}
+        self.found = set()
+
+    def add(self, file_path, groups):
+        for match, hits in sorted(groups.iteritems()):
+            self.found.add(match)
+            key = (match, file_path) if self.counts else (match, None)
+            pending = self.pending.setdefault(key, [])
+            pending.extend(hits)
+            if len(pending) >= self.group_size:
+                # full groups are written, the rest stays pending
+                nb_full = len(pending) - len(pending) % self.group_size
+                for start in xrange(0, nb_full, self.group_size):
+                    self.write(key, pending[start:start + self.group_size])
+                del pending[:nb_full]
+                if not pending:
+                    del self.pending[key]
+
+    def write(self, key, hits):
+        match, file_path = key
+        record = {"term": match, "count": len(hits)}
+        if self.counts:
+            record["file"] = file_path
+            record["offsets"] = hits
+        else:
+            record["lines"] = hits
+        self.f_out.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def close(self):
+        for key, hits in self.pending.iteritems():
+            self.write(key, hits)
+        self.pending = {}
+        for match in sorted(set(self.matches) - self.found):
+            self.write((match, None), [])
+        self.f_out.flush()
+
+
 # Main Entry Point
 if __name__ == '__main__':
-    usage = "Usage: %prog <egrep_expr> <grep_output>"
+    usage = ("Usage: %prog <egrep_expr> <grep_output>\n"
+             "       %prog --ndjson <egrep_expr> [grep_output ...]\n"
+             "       %prog --search <egrep_expr> <log_file_or_dir> ...")
     parser = OptionParser(usage=usage, version="%prog 1.0")
+    parser.add_option("-c", "--counts",
+                      action="store_true", default=False,
+                      dest="counts",
+                      help=("print hit counts and line byte offsets"
+                            " instead of the grouped lines"))
+    parser.add_option("--ndjson",
+                      action="store_true", default=False,
+                      dest="ndjson",
+                      help=("stream groups of several grep outputs, or stdin,"
+                            " as JSON lines"))
+    parser.add_option("-j", "--jobs",
+                      action="store", type="int", default=1,
+                      dest="jobs", metavar="N",
+                      help=("with --ndjson or --search, group chunks in N"
+                            " processes"))
+    parser.add_option("--group-size",
+                      action="store", type="int", default=GROUP_SIZE,
+                      dest="group_size", metavar="N",
+                      help=("with --ndjson, write a group once it holds N"
+                            " hits [default: %default]"))
+
+    parser.add_option("--state",
+                      action="store", default=None,
+                      dest="state_path", metavar="FILE",
+                      help=("with --search, search only the lines appended"
+                            " since the run saving FILE"))
+    parser.add_option("--search",
+                      action="store_true", default=False,
+                      dest="search",
+                      help=("search the terms in log files and directories,"
+                            " gzip files included, instead of grep outputs"))
 
     (options, args) = parser.parse_args()
 
-    if len(sys.argv) != 3:
+    if options.search and len(args) >= 2:
+        run_search(args[0], args[1:], options.jobs, options.counts,
+                   options.ndjson, options.group_size, options.state_path)
+        sys.exit()
+
+    if options.ndjson and len(args) >= 1:
+        run_stream(args[0], args[1:], options.jobs, options.counts,
+                   options.group_size)
+        sys.exit()
+
+    if len(args) != 2:
         parser.print_help()
+        sys.exit(2)
 
-    run(args[0], args[1])
+    run(args[0], args[1], options.counts)
 
     sys.exit()